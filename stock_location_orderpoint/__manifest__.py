@@ -6,7 +6,7 @@
     "author": "MT Software, BCIM, Odoo Community Association (OCA)",
     "summary": "Declare orderpoint on a location "
     "allowing to replenish any product with the same criteria.",
-    "version": "16.0.2.0.1",
+    "version": "16.0.2.1.0",
     "data": [
         "security/ir.model.access.csv",
         "data/ir_cron.xml",
@@ -15,6 +15,7 @@
         "data/queue_job_function.xml",
         "views/stock_location_orderpoint_views.xml",
         "views/stock_location.xml",
+        "views/stock_location_orderpoint_run_views.xml",
         "views/menu.xml",
     ],
     "demo": [
@@ -0,0 +1,26 @@
+# Copyright 2026 Michael Tietz (MT Software) <mtietz@mt-software.de>
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+from openupgradelib import openupgrade
+
+
+@openupgrade.migrate()
+def migrate(env, version):
+    # the cron progress is moved from the orderpoints to their watermarks
+    if not openupgrade.column_exists(
+        env.cr, "stock_location_orderpoint", "last_cron_execution"
+    ):
+        return
+    openupgrade.logged_query(
+        env.cr,
+        """
+        INSERT INTO stock_location_orderpoint_watermark
+            (orderpoint_id, last_cron_execution)
+        SELECT id, last_cron_execution
+        FROM stock_location_orderpoint
+        WHERE last_cron_execution IS NOT NULL
+        ON CONFLICT (orderpoint_id) DO NOTHING
+        """,
+    )
+    openupgrade.drop_columns(
+        env.cr, [("stock_location_orderpoint", "last_cron_execution")]
+    )
@@ -2,3 +2,9 @@ from . import stock_location_orderpoint
 from . import stock_rule
 from . import stock_move
 from . import stock_location
+from . import stock_location_orderpoint_ledger
+from . import stock_quant
+from . import stock_location_orderpoint_in_flight
+from . import stock_location_orderpoint_run
+from . import stock_location_orderpoint_watermark
+from . import procurement_group
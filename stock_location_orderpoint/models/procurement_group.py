@@ -0,0 +1,51 @@
+# Copyright 2026 Michael Tietz (MT Software) <mtietz@mt-software.de>
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+from odoo import api, fields, models
+from odoo.tools.sql import create_index
+
+
+class ProcurementGroup(models.Model):
+    _inherit = "procurement.group"
+
+    location_orderpoint_id = fields.Many2one(
+        "stock.location.orderpoint",
+        "Stock location orderpoint",
+        readonly=True,
+        ondelete="set null",
+    )
+    location_orderpoint_shard_key = fields.Char(
+        readonly=True,
+        help="Technical field identifying the picking shard of the location "
+        "orderpoint grouped by this procurement group",
+    )
+
+    def init(self):
+        # only the picking shards of the location orderpoints are searched
+        create_index(
+            self._cr,
+            "procurement_group_location_orderpoint_shard_index",
+            self._table,
+            ["location_orderpoint_id", "location_orderpoint_shard_key"],
+            where="location_orderpoint_shard_key IS NOT NULL",
+        )
+
+    @api.autovacuum
+    def _gc_location_orderpoint_shards(self):
+        """Deletes the picking shard groups of the location orderpoints left
+        without moves nor pickings"""
+        self.env["stock.move"].flush_model(["group_id"])
+        self.env["stock.picking"].flush_model(["group_id"])
+        self.env.cr.execute(
+            """
+            SELECT id FROM procurement_group pg
+            WHERE location_orderpoint_shard_key IS NOT NULL
+                AND create_date < (now() at time zone 'UTC') - interval '1 day'
+                AND NOT EXISTS(
+                    SELECT 1 FROM stock_move WHERE group_id = pg.id
+                )
+                AND NOT EXISTS(
+                    SELECT 1 FROM stock_picking WHERE group_id = pg.id
+                )
+            """
+        )
+        self.browse([row[0] for row in self.env.cr.fetchall()]).unlink()
@@ -16,6 +16,12 @@ class StockLocation(models.Model):
     location_orderpoint_count = fields.Integer(
         compute="_compute_location_orderpoint_count",
     )
+    location_orderpoint_ledger_initialized = fields.Boolean(
+        readonly=True,
+        copy=False,
+        help="Technical field set when the forecast ledger of the location "
+        "orderpoints has been initialized for this location.",
+    )
 
     def _compute_location_orderpoint_count(self):
         groups = self.env["stock.location.orderpoint"].read_group(
@@ -27,6 +33,39 @@ class StockLocation(models.Model):
         for location in self:
             location.location_orderpoint_count = result.get(location.id, 0)
 
+    def write(self, vals):
+        if "location_id" not in vals:
+            return super().write(vals)
+        ancestors = self._get_ledger_initialized_ancestors()
+        res = super().write(vals)
+        # the parent paths of the location and its children changed
+        self.env["stock.location.orderpoint"]._clear_caches()
+        # the quantities of the moved locations are no longer included in
+        # their old ancestors but in their new ones
+        self.env["stock.location.orderpoint.ledger"].sudo()._initialize_locations(
+            ancestors | self._get_ledger_initialized_ancestors()
+        )
+        return res
+
+    def _get_ledger_initialized_ancestors(self):
+        """Returns the ancestors of the locations whose forecast ledger is
+        initialized"""
+        ancestor_ids = {
+            location_id
+            for location in self
+            for location_id in location._get_parent_path_ids()
+        } - set(self.ids)
+        return (
+            self.sudo()
+            .browse(ancestor_ids)
+            .filtered("location_orderpoint_ledger_initialized")
+        )
+
+    def _get_parent_path_ids(self):
+        """Returns the ids of the location and all its parents"""
+        self.ensure_one()
+        return [int(location_id) for location_id in self.parent_path.split("/")[:-1]]
+
     def action_open_location_orderpoints(self):
         action = self.env["ir.actions.act_window"]._for_xml_id(
             "stock_location_orderpoint.action_stock_location_orderpoint"
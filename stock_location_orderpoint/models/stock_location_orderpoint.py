@@ -1,16 +1,86 @@
 # Copyright 2023 Michael Tietz (MT Software) <mtietz@mt-software.de>
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
-from collections import defaultdict
+import hashlib
+import logging
+import time
+import warnings
+from collections import Counter, defaultdict
+from contextlib import contextmanager
 from copy import copy
-from datetime import timedelta
+from datetime import datetime, timedelta
+from operator import ge, gt, le, lt
+
+from psycopg2 import sql
 
 from odoo import _, api, fields, models, tools
-from odoo.exceptions import ValidationError
+from odoo.exceptions import UserError, ValidationError
 from odoo.osv import expression
-from odoo.tools import float_compare, split_every
+from odoo.tools import float_compare, float_round, split_every
+from odoo.tools.cache import STAT
+from odoo.tools.safe_eval import safe_eval
 
+from odoo.addons.base.models.ir_cron import _intervalTypes
+from odoo.addons.queue_job.exception import RetryableJobError
+from odoo.addons.queue_job.job import identity_exact
 from odoo.addons.stock.models.stock_move import PROCUREMENT_PRIORITIES
 
+_logger = logging.getLogger(__name__)
+# the timings of the replenishment phases, on their own logger so that they
+# can be toggled separately (e.g. --log-handler=<logger name>:WARNING)
+_perf_logger = logging.getLogger(__name__ + ".perf")
+
+MOVE_TODO_STATES = ("waiting", "confirmed", "assigned", "partially_available")
+COMPARATORS = {"<": lt, "<=": le, ">": gt, ">=": ge}
+# functions merging the values of the leaves of domains with the same shape
+# into the value of a leaf selecting a superset of the records
+LEAF_VALUE_MERGERS = {
+    ">": min,
+    ">=": min,
+    "<": max,
+    "<=": max,
+    "in": lambda *values: sorted(set().union(*values)),
+    "child_of": lambda *values: sorted(set().union(*values)),
+}
+
+
+# Above this number of products, the replenishment locks the whole locations
+REPLENISHMENT_LOCK_MAX_PRODUCTS = 100
+REPLENISHMENT_LOCK_RETRY_SECONDS = 5
+# Counters of the current worker process, reset when the worker is recycled
+REPLENISHMENT_LOCK_STATS = Counter()
+TRY_LOCK_QUERIES = {
+    False: "SELECT pg_try_advisory_xact_lock(%s)",
+    True: "SELECT pg_try_advisory_xact_lock_shared(%s)",
+}
+LOCK_QUERIES = {
+    False: "SELECT pg_advisory_xact_lock(%s)",
+    True: "SELECT pg_advisory_xact_lock_shared(%s)",
+}
+
+
+# aggregates the moves selected by a domain into the earliest date of each
+# product per location
+CANDIDATES_QUERY = """
+    WITH candidate_moves AS ({})
+    SELECT location_id, product_id, MIN(date)
+    FROM candidate_moves
+    GROUP BY location_id, product_id
+"""
+
+
+def _advisory_lock_key(*values):
+    """Returns a bigint advisory lock key for the given values"""
+    digest = hashlib.sha1(
+        repr(("stock.location.orderpoint",) + values).encode("utf-8")
+    ).digest()
+    return int.from_bytes(digest[:8], "big", signed=True)
+
+
+def _zero_quantities():
+    return dict.fromkeys(
+        ("qty_available", "incoming_qty", "outgoing_qty", "virtual_available"), 0.0
+    )
+
 
 class StockLocationOrderpoint(models.Model):
     _name = "stock.location.orderpoint"
@@ -78,14 +148,48 @@ class StockLocationOrderpoint(models.Model):
         "If none is given, the moves generated by stock rules "
         "will be grouped into one big picking.",
     )
-    location_src_id = fields.Many2one(
-        "stock.location", compute="_compute_location_src_id", store=True
+    picking_sharding = fields.Selection(
+        [
+            ("none", "Single Picking"),
+            ("time", "Time Bucket"),
+            ("transaction", "Job Slot"),
+        ],
+        default="none",
+        required=True,
+        help="Defines how the moves are split into pickings when no procurement "
+        "group is set\n"
+        "Single Picking = all the moves are grouped into one big picking\n"
+        "Time Bucket = the moves of each period of time are grouped into one "
+        "picking per worker slot. New groups are created for each period.\n"
+        "Job Slot = the moves of each replenishment job are grouped into one of "
+        "a fixed number of pickings. Two parallel jobs may share a picking.\n"
+        "Splitting the pickings avoids the parallel replenishments to wait "
+        "for each other to update the same picking, but gives more pickings to "
+        "process.",
+    )
+
+    use_forecast_ledger = fields.Boolean(
+        help="Read the quantities of the locations of this orderpoint from a "
+        "ledger maintained on each stock move update instead of aggregating "
+        "all the quants and moves on each replenishment. The ledger is not used "
+        "when a domain to filter locations is set.",
     )
-    active = fields.Boolean(default=True)
 
     last_cron_execution = fields.Datetime(
+        compute="_compute_last_cron_execution",
+        inverse="_inverse_last_cron_execution",
         help="Last time this orderpoint was processed by the cron",
     )
+    cron_move_selection = fields.Selection(
+        [("date", "Scheduled Date"), ("write_date", "Last Update")],
+        default="date",
+        required=True,
+        help="Defines how the scheduled orderpoints select the moves to process\n"
+        "Scheduled Date = the moves scheduled since the last cron execution\n"
+        "Last Update = the moves updated since the last cron execution. "
+        "Unlike the scheduled date, it never misses a move planned in the past "
+        "nor processes again a move scheduled in the future.",
+    )
 
     priority = fields.Selection(
         PROCUREMENT_PRIORITIES,
@@ -156,33 +260,358 @@ class StockLocationOrderpoint(models.Model):
             "route_ids": self.route_id,
             "date_deadline": False,
             "warehouse_id": self.location_id.warehouse_id,
-            "group_id": self.group_id,
+            "group_id": self.group_id or self._get_picking_shard_group(),
             "priority": self.priority or "0",
             "location_orderpoint_id": self.id,
         }
 
+    @api.model
+    def _get_picking_shard_minutes(self):
+        return int(
+            self.env["ir.config_parameter"]
+            .sudo()
+            .get_param("stock_location_orderpoint.picking_shard_minutes", 10)
+        )
+
+    @api.model
+    def _get_picking_shard_count(self):
+        return int(
+            self.env["ir.config_parameter"]
+            .sudo()
+            .get_param("stock_location_orderpoint.picking_shard_count", 8)
+        )
+
+    def _get_picking_shard_key(self):
+        """Returns the key of the picking shard of the current replenishment
+
+        The key only depends on the current transaction: the time bucket and
+        the slot of the database connection of the worker, or the slot of the
+        job. The number of slots is bounded by _get_picking_shard_count.
+        """
+        self.ensure_one()
+        if self.picking_sharding == "time":
+            bucket = timedelta(minutes=self._get_picking_shard_minutes())
+            now = self.env.cr.now()
+            self.env.cr.execute("SELECT pg_backend_pid()")
+            return "%s/%s" % (
+                fields.Datetime.to_string(now - (now - datetime.min) % bucket),
+                self.env.cr.fetchone()[0] % self._get_picking_shard_count(),
+            )
+        if self.picking_sharding == "transaction":
+            job_key = self.env.context.get("job_uuid")
+            if not job_key:
+                self.env.cr.execute("SELECT txid_current()")
+                job_key = self.env.cr.fetchone()[0]
+            digest = hashlib.sha1(str(job_key).encode("utf-8")).digest()
+            slot = int.from_bytes(digest[:8], "big") % self._get_picking_shard_count()
+            return "slot-%s" % slot
+        return False
+
+    def _get_picking_shard_group(self):
+        """Returns the procurement group of the picking shard of the current
+        replenishment, an empty recordset if the moves are not sharded
+
+        The groups are found by orderpoint and shard key, which are indexed.
+        """
+        self.ensure_one()
+        group_obj = self.env["procurement.group"]
+        shard_key = self._get_picking_shard_key()
+        if not shard_key:
+            return group_obj
+        group = group_obj.sudo().search(
+            [
+                ("location_orderpoint_id", "=", self.id),
+                ("location_orderpoint_shard_key", "=", shard_key),
+            ],
+            limit=1,
+        )
+        if not group:
+            group = group_obj.sudo().create(
+                {
+                    "name": f"{self.name}/{shard_key}",
+                    "location_orderpoint_id": self.id,
+                    "location_orderpoint_shard_key": shard_key,
+                }
+            )
+        return group_obj.browse(group.id)
+
     def _get_group_by_domain_config(self):
         """Returns a list of orederpoints fields for which orderpoints
         with the same value will generate the same domain for the moves
         The location_id should be excluded. The location domain will be applied
         to each group of orderpoints.
         """
-        return ["last_cron_execution", "trigger", "replenish_method"]
+        return [
+            "last_cron_execution",
+            "trigger",
+            "replenish_method",
+            "cron_move_selection",
+        ]
+
+    def _get_group_by_watermark_config(self):
+        """Returns the fields of _get_group_by_domain_config holding the
+        progress of the cron. Their domain is applied to each group of
+        orderpoints like the location domain and is not cached.
+        """
+        return ["last_cron_execution"]
+
+    def _get_domain_group_key(self, fields_list=None):
+        """Returns a hashable key of the values of the given fields, by default
+        the fields returned by _get_group_by_domain_config.
+        """
+        self.ensure_one()
+        if fields_list is None:
+            fields_list = self._get_group_by_domain_config()
+        return tuple(
+            tuple(value.ids) if isinstance(value, models.BaseModel) else value
+            for value in (self[field] for field in fields_list)
+        )
+
+    def _get_domain_cache_key(self):
+        """Returns the key of the cached domain fragments of the orderpoint,
+        which excludes the cron watermark fields
+        """
+        watermark_fields = self._get_group_by_watermark_config()
+        return self._get_domain_group_key(
+            [
+                field
+                for field in self._get_group_by_domain_config()
+                if field not in watermark_fields
+            ]
+        )
+
+    def _compute_last_cron_execution(self):
+        dates = (
+            self.env["stock.location.orderpoint.watermark"]
+            .sudo()
+            ._get_last_cron_executions(self)
+        )
+        for orderpoint in self:
+            orderpoint.last_cron_execution = dates.get(orderpoint.id, False)
+
+    def _inverse_last_cron_execution(self):
+        watermarks = self.env["stock.location.orderpoint.watermark"].sudo()
+        for orderpoint in self:
+            watermarks._set_last_cron_execution(
+                orderpoint, orderpoint.last_cron_execution
+            )
+
+    def _set_last_cron_execution(self, date):
+        """Stores the cron progress of the orderpoints
+
+        The progress is stored outside of the orderpoints, so that the cron
+        does not update the orderpoints nor clear the caches depending on them
+        """
+        self.env["stock.location.orderpoint.watermark"].sudo()._set_last_cron_execution(
+            self, date
+        )
+        self.invalidate_recordset(["last_cron_execution"])
+
+    def _init_last_cron_execution(self):
+        """Initializes the last cron execution of the scheduled orderpoints
+        never executed to a date 1 week ago, to avoid selecting all moves
+        when the cron is executed for the first time
+        """
+        orderpoints = self.filtered(
+            lambda orderpoint: orderpoint.trigger == "cron"
+            and not orderpoint.last_cron_execution
+        )
+        if orderpoints:
+            orderpoints._set_last_cron_execution(self.env.cr.now() - timedelta(days=7))
 
     def _group_by_domain_config(self):
         """Returns an iterator of orderpoints for which the values of the fields
         returned by _get_group_by_domain_config will be the same.
         """
+        self._init_last_cron_execution()
         groups = defaultdict(list)
         for orderpoint in self:
-            group_key = tuple(
-                getattr(orderpoint, field)
-                for field in orderpoint._get_group_by_domain_config()
-            )
-            groups[group_key].append(orderpoint.id)
+            groups[orderpoint._get_domain_group_key()].append(orderpoint.id)
         for group in groups.values():
             yield self.browse(group)
 
+    @api.model
+    @tools.ormcache("kind", "group_key")
+    def _get_moves_domain_fragment(self, kind, group_key, orderpoint_id):
+        """Returns the domain returned by _get_consuming_moves_domain_for_group
+        or _get_replenishment_moves_domain_for_group for a group of orderpoints
+
+        The domain does not depend on the locations nor on the cron progress
+        of the orderpoints so it is cached by group key only. Writing on the
+        fields of the group key does not need to clear the cache: the
+        orderpoints get a new key.
+
+        :param str kind: consuming or replenishment
+        :param tuple group_key: the key returned by _get_domain_cache_key
+        :param int orderpoint_id: an orderpoint of the group, used to build
+            the domain
+        """
+        orderpoint = self.browse(orderpoint_id)
+        if kind == "consuming":
+            return orderpoint._get_consuming_moves_domain_for_group()
+        return orderpoint._get_replenishment_moves_domain_for_group()
+
+    @api.model
+    def _get_moves_domain_cache_stats(self):
+        """Returns the hit and miss counters of the moves domain cache"""
+        counter = STAT[
+            (
+                self.env.registry.db_name,
+                self._name,
+                self._get_moves_domain_fragment.__cache__.method,
+            )
+        ]
+        return {"hit": counter.hit, "miss": counter.miss}
+
+    def _get_moves_domain_for_groups(self, kind, location_field):
+        """Returns the domain fragments of each group of orderpoints
+        combined with the locations of the group
+
+        :param str kind: consuming or replenishment
+        :param str location_field: the move location field to compare to
+            the orderpoints location_id (consuming) or location_src_id
+            (replenishment)
+        """
+        orderpoint_location_field = (
+            "location_id" if kind == "consuming" else "location_src_id"
+        )
+        groups = []
+        for orderpoints in self._group_by_domain_config():
+            first = orderpoints[0]
+            groups.append(
+                [
+                    (
+                        location_field,
+                        "child_of",
+                        orderpoints[orderpoint_location_field].ids,
+                    )
+                ]
+                + orderpoints._get_watermark_domain_for_group()
+                + self._get_moves_domain_fragment(
+                    kind, first._get_domain_cache_key(), first.id
+                )
+            )
+        return expression.OR(self._merge_domains_by_shape(groups))
+
+    @api.model
+    def _get_domain_shape(self, domain):
+        """Returns a hashable shape of a domain made of leaves only, in which
+        the values of the leaves that can be merged are ignored, or None if
+        the domain contains operators
+        """
+        shape = []
+        for leaf in domain:
+            if not expression.is_leaf(leaf):
+                return None
+            fname, operator, value = leaf
+            if operator in LEAF_VALUE_MERGERS:
+                shape.append((fname, operator))
+            else:
+                shape.append((fname, operator, repr(value)))
+        return tuple(shape)
+
+    @api.model
+    def _merge_domains_by_shape(self, domains):
+        """Merges the domains with the same shape into one domain selecting a
+        superset of the records selected by each domain (e.g. the minimum of
+        the lower bounds, the union of the in-lists).
+
+        It keeps the number of OR-ed domains bounded by the number of
+        different orderpoint configurations, whatever the number of orderpoints
+        and of their cron executions. Selecting more moves is harmless, the
+        quantities to replenish being computed from the forecast quantities.
+
+        :param domains: list of domains
+        :return: list of domains
+        """
+        shapes = defaultdict(list)
+        merged = []
+        for domain in domains:
+            shape = self._get_domain_shape(domain)
+            if shape is None:
+                merged.append(domain)
+            else:
+                shapes[shape].append(domain)
+        for same_shape_domains in shapes.values():
+            leaves = []
+            for index, (fname, operator, value) in enumerate(same_shape_domains[0]):
+                merge = LEAF_VALUE_MERGERS.get(operator)
+                if merge and len(same_shape_domains) > 1:
+                    values = [domain[index][2] for domain in same_shape_domains]
+                    if operator in ("in", "child_of"):
+                        values = [
+                            [item] if isinstance(item, int) else item for item in values
+                        ]
+                    value = merge(*values)
+                leaves.append((fname, operator, value))
+            merged.append(leaves)
+        return merged
+
+    def _get_watermark_domain_for_group(self):
+        """Returns a domain which selects the moves not yet processed by the
+        cron for a list of orderpoints with the same characteristics
+        """
+        first = self[0]
+        if first.trigger != "cron":
+            return []
+        field = first.cron_move_selection
+        date_from = first.last_cron_execution
+        if field == "write_date":
+            # the moves written by the transactions committed while the last
+            # cron execution was running have an older write date
+            date_from -= timedelta(seconds=self._get_cron_write_date_margin())
+        domain = [(field, ">=", date_from)]
+        date_to = self.env.context.get("location_orderpoint_cron_date_to")
+        if date_to:
+            domain.append((field, "<", date_to))
+        return domain
+
+    @api.model
+    def _get_cron_write_date_margin(self):
+        """Returns the number of seconds before the last cron execution from
+        which the moves are selected by last update
+
+        The last cron execution of these orderpoints is the start of the
+        oldest transaction still running at the end of the cron (see
+        _get_oldest_transaction_start). A transaction committed while the cron
+        was running is not covered: it may have started up to the longest
+        expected transaction (system parameter cron_write_date_margin, 300
+        seconds by default) before. The interval of the cron is added to
+        bound the duration of the cron itself. A move written by a
+        transaction longer than the margin can still be missed.
+        """
+        margin = int(
+            self.env["ir.config_parameter"]
+            .sudo()
+            .get_param("stock_location_orderpoint.cron_write_date_margin", 300)
+        )
+        cron = self.env.ref(
+            "stock_location_orderpoint.ir_cron_location_replenishment",
+            raise_if_not_found=False,
+        )
+        if cron:
+            cron = cron.sudo()
+            now = datetime.now()
+            interval = _intervalTypes[cron.interval_type](cron.interval_number)
+            margin += int((now + interval - now).total_seconds())
+        return margin
+
+    @api.model
+    def _get_oldest_transaction_start(self):
+        """Returns the start of the oldest transaction running on the database
+
+        A move written by a transaction still running is not visible to the
+        cron, but its last update is the start of that transaction.
+        """
+        self.env.cr.execute(
+            """
+            SELECT MIN(xact_start) AT TIME ZONE 'UTC'
+            FROM pg_stat_activity
+            WHERE datname = current_database()
+            """
+        )
+        return self.env.cr.fetchone()[0]
+
     def _get_consuming_moves_domain_for_group(self):
         """Returns a domain which selects moves the outgoings that could
         introduce a shortage at the location for a list of orderpoints
@@ -190,12 +619,6 @@ class StockLocationOrderpoint(models.Model):
         """
         first = self[0]
         domain = []
-        if first.trigger == "cron":
-            if not first.last_cron_execution:
-                # initialize a date 1 week ago to avoid selecting all moves
-                # when the cron is executed for the first time
-                first.last_cron_execution = self.env.cr.now() - timedelta(days=7)
-            domain.append(("date", ">=", first.last_cron_execution))
         if first.replenish_method == "fill_up":
             # with fillup, we know that a replenishment is required when
             # move are waiting availability
@@ -206,128 +629,133 @@ class StockLocationOrderpoint(models.Model):
         """Returns a domain which selects moves the outgoings that could
         introduce a shortage at the location"""
         domain = [
-            ("move_orig_ids", "=", False),
+            ("has_move_orig", "=", False),
             ("procure_method", "=", "make_to_stock"),
         ]
-        if self:
-            domain.append(("location_id", "child_of", self.location_id.ids))
-        groups = []
-        for orderpoints in self._group_by_domain_config():
-            group_domain = orderpoints._get_consuming_moves_domain_for_group()
-            if group_domain:
-                groups.append(group_domain)
-        if not groups:
+        if not self:
             return domain
-        return expression.AND([domain, expression.OR(groups)])
+        return expression.AND(
+            [domain, self._get_moves_domain_for_groups("consuming", "location_id")]
+        )
 
     def _get_replenishment_moves_domain_for_group(self):
         """Returns a domain which selects the incomig moves that could
         allow a replenishment at the location for a list of orderpoints
         with the same characteristics except the location_id
         """
-        first = self[0]
-        domain = []
-        if first.trigger == "cron":
-            if not first.last_cron_execution:
-                # initialize a date 1 week ago to avoid selecting all moves
-                # when the cron is executed for the first time
-                first.last_cron_execution = self.env.cr.now() - timedelta(days=7)
-            domain.append(("date", ">=", first.last_cron_execution))
-        return domain
+        return []
 
     def _get_replenishment_moves_domain(self):
         """Returns a domain which selects moves that could replenish
         the location"""
         domain = [
-            ("move_dest_ids", "=", False),
+            ("has_move_dest", "=", False),
             ("procure_method", "=", "make_to_stock"),
             ("state", "=", "done"),
         ]
-        if self:
-            domain.append(("location_dest_id", "child_of", self.location_src_id.ids))
-        groups = []
-        for orderpoints in self._group_by_domain_config():
-            group_domain = orderpoints._get_replenishment_moves_domain_for_group()
-            if group_domain:
-                groups.append(group_domain)
-        if not groups:
+        if not self:
             return domain
-        return expression.AND([domain, expression.OR(groups)])
+        return expression.AND(
+            [
+                domain,
+                self._get_moves_domain_for_groups("replenishment", "location_dest_id"),
+            ]
+        )
 
     @api.model
-    @tools.ormcache("ids")
-    def _get_consuming_moves_domain_for_ids(self, ids=None):
+    def _get_moves_domain(self, ids):
         """
+        Returns a domain which selects moves replenishing or consuming
+        the locations of orderpoints with given ids
+        """
+        orderpoints = self.browse(ids)
+        return expression.OR(
+            [
+                orderpoints._get_replenishment_moves_domain(),
+                orderpoints._get_consuming_moves_domain(),
+            ]
+        )
 
-        Returns a domain which selects moves the outgoings that could
-        introduce a shortage at the location for a list of orderpoints
+    @api.model
+    def _get_consuming_moves_domain_for_ids(self, ids=None):
+        """Deprecated: use _get_consuming_moves_domain on the orderpoints
 
         :param frozenset() ids: The orderpoint ids
         """
-        if ids is not None:
-            ids = list(ids)
-        orderpoints = self.browse(ids) if ids else self.search([])
+        warnings.warn(
+            "_get_consuming_moves_domain_for_ids is deprecated, "
+            "use _get_consuming_moves_domain",
+            DeprecationWarning,
+            stacklevel=2,
+        )
+        orderpoints = self.browse(list(ids)) if ids else self.search([])
         return orderpoints._get_consuming_moves_domain()
 
     @api.model
-    @tools.ormcache("ids")
     def _get_replenishment_moves_domain_for_ids(self, ids=None):
-        """
-
-        Returns a domain which selects moves that could replenish
-        the location for a list of orderpoints
+        """Deprecated: use _get_replenishment_moves_domain on the orderpoints
 
         :param frozenset() ids: The orderpoint ids
         """
-        if ids is not None:
-            ids = list(ids)
-        orderpoints = self.browse(ids) if ids else self.search([])
+        warnings.warn(
+            "_get_replenishment_moves_domain_for_ids is deprecated, "
+            "use _get_replenishment_moves_domain",
+            DeprecationWarning,
+            stacklevel=2,
+        )
+        orderpoints = self.browse(list(ids)) if ids else self.search([])
         return orderpoints._get_replenishment_moves_domain()
 
-    @api.model
-    def _get_moves_domain(self, ids):
-        """
-        Returns a domain which selects moves replenishing or consuming
-        the locations of orderpoints with given ids
-        """
-        ids = frozenset(ids)
-        return expression.OR(
-            [
-                self._get_replenishment_moves_domain_for_ids(ids),
-                self._get_consuming_moves_domain_for_ids(ids),
-            ]
-        )
+    def _find_potential_products_to_replenish_by_location(self, products=False):
+        """Returns the products that potentially require a replenishment per
+        location with the date of their earliest move
+
+        The moves are aggregated by one SQL statement per domain instead of
+        being browsed.
 
-    def _find_potential_moves_to_replenish_by_location(self, products=False):
-        """Return a dictionary of products per location that potentially require a replenishment
-        based on the fact there are moves not reserved for those products.
-        This reduces the list of products for which the quantity will be computed"""
-        # We don't use the _get_moves_domain method because. We prefer to make
-        # 2 queries instead of 1 with a big OR statement because the query
-        # planner is not able to use the indexes properly
-        location_ids = []
+        :return: dict {(location_id, product_id): date}
+        """
+        move_obj = self.env["stock.move"]
+        move_obj.flush_model()
+        dates = {}
         domains = [
-            self._get_replenishment_moves_domain_for_ids(frozenset(self.ids)),
-            self._get_consuming_moves_domain_for_ids(frozenset(self.ids)),
+            self._get_replenishment_moves_domain(),
+            self._get_consuming_moves_domain(),
         ]
-        result = {}
         for domain in domains:
             if products:
                 domain = expression.AND([domain, [("product_id", "in", products.ids)]])
-            moves_grouped = self.env["stock.move"].read_group(
-                domain,
-                ["ids:array_agg(id)", "location_id"],
-                "location_id",
-                orderby="id",
+            query = move_obj._where_calc(domain)
+            move_obj._apply_ir_rules(query, "read")
+            query_str, params = query.select(
+                '"stock_move"."location_id"',
+                '"stock_move"."product_id"',
+                '"stock_move"."date"',
+            )
+            self.env.cr.execute(
+                sql.SQL(CANDIDATES_QUERY).format(sql.SQL(query_str)), params
             )
-            for res in moves_grouped:
-                location_ids.append(res["location_id"][0])
-                result.setdefault(res["location_id"][0], []).extend(res["ids"])
+            for location_id, product_id, date in self.env.cr.fetchall():
+                key = (location_id, product_id)
+                if key not in dates or date < dates[key]:
+                    dates[key] = date
+        return dates
+
+    @api.model
+    def _get_products_by_location(self, dates_planned):
+        """Returns the products per location of the result of
+        _find_potential_products_to_replenish_by_location
+
+        :return: dict {location: products}
+        """
+        product_ids_by_location_id = defaultdict(list)
+        for location_id, product_id in dates_planned:
+            product_ids_by_location_id[location_id].append(product_id)
         return {
             self.env["stock.location"]
-            .browse(location_ids): self.env["stock.move"]
-            .browse(mode_ids)
-            for location_ids, mode_ids in result.items()
+            .browse(location_id): self.env["product.product"]
+            .browse(sorted(product_ids))
+            for location_id, product_ids in product_ids_by_location_id.items()
         }
 
     def _sort_orderpoints(self):
@@ -335,17 +763,133 @@ class StockLocationOrderpoint(models.Model):
 
     @api.model
     def _compute_quantities_dict(self, locations, products):
-        qties = {}
-        for location in locations:
-            qties_on_location = qties.setdefault(location, {})
-            products = products.with_context(location=location.id)
-            for product_id, qties_dict in products._compute_quantities_dict(
-                None, None, None
-            ).items():
-                product = products.browse(product_id)
-                qties_on_location[product] = qties_dict
+        """Returns the quantities of the given products on the given locations
+
+        :param locations: browse record list of stock.location
+        :param products: browse record list of product.product. Its context
+            is used to build the location domains (e.g. excluded_location_domain)
+        :return: dict {location: {product: {qty_available, incoming_qty,
+            outgoing_qty, virtual_available}}}. Products without any quant or
+            move on a location get zero quantities.
+        """
+        qties = {location: defaultdict(_zero_quantities) for location in locations}
+        if not locations or not products:
+            return qties
+        ledger = self.env["stock.location.orderpoint.ledger"]
+        if ledger._can_compute_quantities(locations, products):
+            totals = ledger._get_quantities_totals(locations, products)
+        else:
+            totals = self._get_quantities_totals(locations, products)
+        location_obj = self.env["stock.location"]
+        for (location_id, product_id), quantities in totals.items():
+            product = products.browse(product_id)
+            rounding = product.uom_id.rounding
+            qties_dict = {
+                field: float_round(quantities[field], precision_rounding=rounding)
+                for field in ("qty_available", "incoming_qty", "outgoing_qty")
+            }
+            qties_dict["virtual_available"] = float_round(
+                qties_dict["qty_available"]
+                + qties_dict["incoming_qty"]
+                - qties_dict["outgoing_qty"],
+                precision_rounding=rounding,
+            )
+            qties[location_obj.browse(location_id)][product] = qties_dict
         return qties
 
+    @api.model
+    def _get_quantities_totals(self, locations, products=None):
+        """Aggregates the quants and the moves of the given locations
+
+        The quants, the incoming and the outgoing moves of all the locations
+        are aggregated with one grouped query each, then dispatched to every
+        requested location they belong to thanks to their parent_path.
+
+        :param locations: browse record list of stock.location
+        :param products: browse record list of product.product, all products
+            if None. Its context is used to build the location domains.
+        :return: dict {(location_id, product_id): {qty_available,
+            incoming_qty, outgoing_qty}} of unrounded quantities
+        """
+        if products is None:
+            product_domain = []
+            products = self.env["product.product"]
+        else:
+            product_domain = [("product_id", "in", products.ids)]
+        quant_domains, move_in_domains, move_out_domains = [], [], []
+        for location in locations:
+            (
+                quant_domain,
+                move_in_domain,
+                move_out_domain,
+            ) = products._get_domain_locations_new(location.ids)
+            quant_domains.append(quant_domain)
+            move_in_domains.append(move_in_domain)
+            move_out_domains.append(move_out_domain)
+        move_todo_domain = expression.AND(
+            [product_domain, [("state", "in", MOVE_TODO_STATES)]]
+        )
+        quant_obj = self.env["stock.quant"].with_context(active_test=False)
+        move_obj = self.env["stock.move"].with_context(active_test=False)
+        quants_grouped = quant_obj.read_group(
+            expression.AND([product_domain, expression.OR(quant_domains)]),
+            ["quantity:sum"],
+            ["location_id", "product_id"],
+            orderby="id",
+            lazy=False,
+        )
+        moves_in_grouped = move_obj.read_group(
+            expression.AND([move_todo_domain, expression.OR(move_in_domains)]),
+            ["product_qty:sum"],
+            ["location_id", "location_dest_id", "product_id"],
+            orderby="id",
+            lazy=False,
+        )
+        moves_out_grouped = move_obj.read_group(
+            expression.AND([move_todo_domain, expression.OR(move_out_domains)]),
+            ["product_qty:sum"],
+            ["location_id", "location_dest_id", "product_id"],
+            orderby="id",
+            lazy=False,
+        )
+
+        # Resolve, for each location found in the results, the requested
+        # locations it is a child of
+        row_location_ids = {res["location_id"][0] for res in quants_grouped}
+        for res in moves_in_grouped + moves_out_grouped:
+            row_location_ids.add(res["location_id"][0])
+            row_location_ids.add(res["location_dest_id"][0])
+        requested_location_ids = set(locations.ids)
+        parents_by_location_id = {
+            location.id: requested_location_ids.intersection(
+                location._get_parent_path_ids()
+            )
+            for location in self.env["stock.location"].browse(row_location_ids)
+        }
+
+        totals = defaultdict(lambda: defaultdict(float))
+        for res in quants_grouped:
+            product_id = res["product_id"][0]
+            for location_id in parents_by_location_id[res["location_id"][0]]:
+                totals[(location_id, product_id)]["qty_available"] += res["quantity"]
+        for res, qty_field in (
+            (moves_in_grouped, "incoming_qty"),
+            (moves_out_grouped, "outgoing_qty"),
+        ):
+            for move_res in res:
+                product_id = move_res["product_id"][0]
+                src_parents = parents_by_location_id[move_res["location_id"][0]]
+                dest_parents = parents_by_location_id[move_res["location_dest_id"][0]]
+                if qty_field == "incoming_qty":
+                    location_ids = dest_parents - src_parents
+                else:
+                    location_ids = src_parents - dest_parents
+                for location_id in location_ids:
+                    totals[(location_id, product_id)][qty_field] += move_res[
+                        "product_qty"
+                    ]
+        return totals
+
     def _get_qty_to_replenish(
         self, product, qties_on_locations, qty_already_replenished=0
     ):
@@ -397,102 +941,543 @@ class StockLocationOrderpoint(models.Model):
         qty_to_replenish = virtual_available_on_dest - qty_already_replenished
         return min(qty_to_replenish, virtual_available_on_src)
 
-    def _get_qties_to_replenish(self, moves_by_location):
-        products = set()
-        for moves in moves_by_location.values():
-            products.update(moves.product_id.ids)
-        qties_replenished = defaultdict(lambda: defaultdict(lambda: 0))
-        qties_to_replenish = defaultdict(list)
+    @api.model
+    def _use_batch_qties_to_replenish(self):
+        """Returns True if the quantities to replenish are computed for all
+        the products of an orderpoint at once
+
+        Overrides of _get_qty_to_replenish and _get_qty_to_replenish_fill_up
+        are not applied to the batched computation.
+        """
+        return tools.str2bool(
+            self.env["ir.config_parameter"]
+            .sudo()
+            .get_param("stock_location_orderpoint.batch_qties_to_replenish", "0")
+        )
+
+    def _get_qties_to_replenish_for_products(
+        self, products, qties_on_locations, qties_replenished, batch=False
+    ):
+        """Returns the quantities to replenish of the given products
+
+        :param qties_replenished: dict {product: qty} of the quantities
+            already replenished on the location of the orderpoint, updated with
+            the returned quantities
+        :param batch: compute all the products at once, if supported by the
+            replenish method
+        :return: list of (product, qty) of the quantities to replenish
+        """
+        self.ensure_one()
+        if batch and self.replenish_method == "fill_up":
+            return self._get_qties_to_replenish_fill_up_batch(
+                products, qties_on_locations, qties_replenished
+            )
+        qties = []
+        for product in products:
+            qty_to_replenish = self._get_qty_to_replenish(
+                product, qties_on_locations, qties_replenished[product]
+            )
+            if (
+                float_compare(
+                    qty_to_replenish,
+                    0,
+                    precision_rounding=product.uom_id.rounding,
+                )
+                > 0
+            ):
+                qties.append((product, qty_to_replenish))
+                qties_replenished[product] += qty_to_replenish
+        return qties
+
+    def _get_qties_to_replenish_fill_up_batch(
+        self, products, qties_on_locations, qties_replenished
+    ):
+        """Same as _get_qty_to_replenish_fill_up for all the given products at
+        once, see _get_qties_to_replenish_for_products
+
+        The orderpoint and the locations are read once, and comparing a
+        rounded quantity to 0 gives the same result as float_compare.
+        """
+        if not self.location_src_id:
+            return []
+        qties_on_dest = qties_on_locations[self.location_id]
+        qties_on_src = qties_on_locations[self.location_src_id]
+        qties = []
+        for product in products:
+            rounding = product.uom_id.rounding
+            virtual_available_on_dest = qties_on_dest[product]["virtual_available"]
+            if float_round(virtual_available_on_dest, precision_rounding=rounding) >= 0:
+                continue
+            qties_on_src_product = qties_on_src[product]
+            virtual_available_on_src = (
+                qties_on_src_product["virtual_available"]
+                - qties_on_src_product["incoming_qty"]
+            )
+            if float_round(virtual_available_on_src, precision_rounding=rounding) <= 0:
+                continue
+            qty_to_replenish = min(
+                -virtual_available_on_dest - qties_replenished[product],
+                virtual_available_on_src,
+            )
+            if float_round(qty_to_replenish, precision_rounding=rounding) > 0:
+                qties.append((product, qty_to_replenish))
+                qties_replenished[product] += qty_to_replenish
+        return qties
+
+    def _get_excluded_location_domain_key(self):
+        """Returns a hashable key of the excluded location domain
+
+        Equivalent domains (e.g. empty or only differing by their implicit
+        '&' operators or their leaf types) share the same key.
+        """
+        self.ensure_one()
+        domain = self.stock_excluded_location_domain or []
+        if isinstance(domain, str):
+            domain = safe_eval(domain)
+        if not domain:
+            return ""
+        return repr(
+            [
+                tuple(term) if isinstance(term, (list, tuple)) else term
+                for term in expression.normalize_domain(domain)
+            ]
+        )
+
+    def _group_by_excluded_location_domain(self):
+        """Returns an iterator of orderpoints sharing an equivalent
+        excluded location domain, thus the same available quantities
+        """
+        groups = defaultdict(list)
         for orderpoint in self:
+            groups[orderpoint._get_excluded_location_domain_key()].append(orderpoint.id)
+        for group in groups.values():
+            yield self.browse(group)
+
+    def _get_qties_on_locations_by_orderpoint(self, products_by_location):
+        """Returns the quantities on locations to use for each orderpoint
+
+        The quantities are computed once for all the orderpoints sharing
+        the same excluded location domain.
+        """
+        qties_by_orderpoint = {}
+        orderpoints = self.filtered(
+            lambda orderpoint: orderpoint.location_id in products_by_location
+        )
+        for group in orderpoints._group_by_excluded_location_domain():
+            products = self.env["product.product"].union(
+                *(products_by_location[location] for location in group.location_id)
+            )
             qties_on_locations = self._compute_quantities_dict(
-                (self.location_id | self.location_src_id),
-                self.env["product.product"]
-                .browse(products)
-                .with_context(
-                    excluded_location_domain=orderpoint.stock_excluded_location_domain
+                group.location_id | group.location_src_id,
+                products.with_context(
+                    excluded_location_domain=group[0].stock_excluded_location_domain
                 ),
             )
-            if orderpoint.location_id not in moves_by_location:
-                continue
+            for orderpoint in group:
+                qties_by_orderpoint[orderpoint] = qties_on_locations
+        return qties_by_orderpoint
 
-            for product in moves_by_location[orderpoint.location_id].product_id:
-                qties_replenished_for_location = qties_replenished[
-                    orderpoint.location_id
-                ]
-                qty_to_replenish = orderpoint._get_qty_to_replenish(
-                    product,
-                    qties_on_locations,
-                    qties_replenished_for_location[product],
-                )
-                if (
-                    float_compare(
-                        qty_to_replenish,
-                        0,
-                        precision_rounding=product.uom_id.rounding,
-                    )
-                    > 0
-                ):
-                    qties_to_replenish[orderpoint].append((product, qty_to_replenish))
-                    qties_replenished_for_location[product] += qty_to_replenish
+    def _get_qties_to_replenish(self, products_by_location):
+        qties_replenished = defaultdict(lambda: defaultdict(lambda: 0))
+        qties_to_replenish = defaultdict(list)
+        qties_by_orderpoint = self._get_qties_on_locations_by_orderpoint(
+            products_by_location
+        )
+        in_flight_model = self.env["stock.location.orderpoint.in.flight"]
+        products = self.env["product.product"].union(*products_by_location.values())
+        # quantities replenished by concurrent transactions
+        for (orderpoint_id, product_id), qty in in_flight_model._get_quantities(
+            self, products
+        ).items():
+            location = self.browse(orderpoint_id).location_id
+            qties_replenished[location][products.browse(product_id)] += qty
+        batch = self._use_batch_qties_to_replenish()
+        for orderpoint in self:
+            if orderpoint.location_id not in products_by_location:
+                continue
+            qties = orderpoint._get_qties_to_replenish_for_products(
+                products_by_location[orderpoint.location_id],
+                qties_by_orderpoint[orderpoint],
+                qties_replenished[orderpoint.location_id],
+                batch=batch,
+            )
+            if qties:
+                qties_to_replenish[orderpoint] = qties
+        in_flight_model._register_quantities(
+            {
+                (orderpoint.id, product.id): qty
+                for orderpoint, qties in qties_to_replenish.items()
+                for product, qty in qties
+            }
+        )
         return qties_to_replenish
 
-    def __prepare_procurements(self, moves_by_location):
-        qties_to_replenish_by_orderpoint = self._get_qties_to_replenish(
-            moves_by_location
-        )
+    def __prepare_procurements(self, dates_planned):
+        with self._replenishment_phase("compute_quantities") as phase:
+            qties_to_replenish_by_orderpoint = self._get_qties_to_replenish(
+                self._get_products_by_location(dates_planned)
+            )
+            phase["count"] = sum(
+                len(qties) for qties in qties_to_replenish_by_orderpoint.values()
+            )
         procurements = []
-        for (
-            orderpoint,
-            qties_to_replenish,
-        ) in qties_to_replenish_by_orderpoint.items():
-            proc_vals = orderpoint._prepare_procurement_values()
-            for product, qty in qties_to_replenish:
-                date_planned = moves_by_location[
-                    orderpoint.location_id
-                ]._get_location_orderpoint_replenishment_date(product)
-                procurements.append(
-                    orderpoint._prepare_procurement(
-                        product, qty, date_planned, proc_vals
+        if not qties_to_replenish_by_orderpoint:
+            return procurements
+        with self._replenishment_phase("prepare_procurements") as phase:
+            for (
+                orderpoint,
+                qties_to_replenish,
+            ) in qties_to_replenish_by_orderpoint.items():
+                proc_vals = orderpoint._prepare_procurement_values()
+                for product, qty in qties_to_replenish:
+                    date_planned = dates_planned[
+                        (orderpoint.location_id.id, product.id)
+                    ]
+                    procurements.append(
+                        orderpoint._prepare_procurement(
+                            product, qty, date_planned, proc_vals
+                        )
                     )
-                )
+            phase["count"] = len(procurements)
         return procurements
 
     def _prepare_procurements(self, products=False):
-        moves_by_location = self._find_potential_moves_to_replenish_by_location(
-            products
+        with self._replenishment_phase("find_moves") as phase:
+            dates_planned = self._find_potential_products_to_replenish_by_location(
+                products
+            )
+            phase["count"] = len(dates_planned)
+            phase["product_count"] = len(
+                {product_id for _location_id, product_id in dates_planned}
+            )
+        if not dates_planned:
+            return []
+        return self._sort_orderpoints().__prepare_procurements(dates_planned)
+
+    @api.model
+    def _get_replenishment_chunk_size(self):
+        """Returns the number of products replenished at once, 0 to replenish
+        all the products at once"""
+        return int(
+            self.env["ir.config_parameter"]
+            .sudo()
+            .get_param("stock_location_orderpoint.replenishment_chunk_size", 0)
+        )
+
+    def _find_potential_product_ids_to_replenish(self, products=False):
+        """Returns the sorted ids of the products that potentially require
+        a replenishment, without reading the moves"""
+        return sorted(
+            {
+                product_id
+                for _location_id, product_id in (
+                    self._find_potential_products_to_replenish_by_location(products)
+                )
+            }
         )
-        return self._sort_orderpoints().__prepare_procurements(moves_by_location)
+
+    def _iter_procurements(self, products=False, chunk_size=0):
+        """Yields the procurements to run by chunks of chunk_size products"""
+        if not chunk_size:
+            self._lock_replenishment(products)
+            yield self._prepare_procurements(products)
+            return
+        product_obj = self.env["product.product"]
+        product_ids = self._find_potential_product_ids_to_replenish(products)
+        # the locks are held until the end of the transaction: take the locks
+        # of all the chunks at once, in the same order as the other ones
+        self._lock_replenishment(product_obj.browse(product_ids))
+        for product_ids_chunk in split_every(chunk_size, product_ids):
+            yield self._prepare_procurements(product_obj.browse(product_ids_chunk))
+
+    def _get_replenishment_lock_keys(self, products=False):
+        """Returns the sorted list of (key, shared) advisory locks to take
+        before replenishing the given products with the orderpoints
+
+        Small product sets lock each (location, product) and share the lock
+        of the location. Otherwise, the locations are locked exclusively.
+        """
+        product_ids = products.ids if products else []
+        lock_products = 0 < len(product_ids) <= REPLENISHMENT_LOCK_MAX_PRODUCTS
+        locks = {}
+        for location_id in (self.location_id | self.location_src_id).ids:
+            locks[_advisory_lock_key(location_id)] = lock_products
+            if not lock_products:
+                continue
+            for product_id in product_ids:
+                locks[_advisory_lock_key(location_id, product_id)] = False
+        return sorted(locks.items())
+
+    def _lock_replenishment(self, products=False):
+        """Takes the advisory locks of the replenished locations and products
+        in a deterministic order, until the end of the transaction.
+
+        Inside a job, a lock held by another transaction postpones the job
+        instead of computing a replenishment that would fail on commit.
+        Otherwise, the transaction waits for the lock. A transaction running
+        several replenishments must take the locks of all of them first (see
+        _run_cron_replenishment), as the locks are held until its end.
+        """
+        cr = self.env.cr
+        may_wait = not self.env.context.get("job_uuid")
+        for key, shared in self._get_replenishment_lock_keys(products):
+            cr.execute(TRY_LOCK_QUERIES[shared], (key,))
+            if cr.fetchone()[0]:
+                continue
+            REPLENISHMENT_LOCK_STATS["conflicts"] += 1
+            if not may_wait:
+                REPLENISHMENT_LOCK_STATS["retries"] += 1
+                _logger.info(
+                    "Replenishment of orderpoints %s postponed by a concurrent "
+                    "replenishment",
+                    self.ids,
+                )
+                raise RetryableJobError(
+                    _("The locations are being replenished by another transaction"),
+                    seconds=REPLENISHMENT_LOCK_RETRY_SECONDS,
+                    ignore_retry=True,
+                )
+            cr.execute(LOCK_QUERIES[shared], (key,))
+
+    @api.model
+    def _get_replenishment_lock_stats(self):
+        """Returns the counters of the replenishment locks of this worker:
+        conflicts (lock held by another transaction) and retries (jobs
+        postponed because of a conflict)
+
+        The counters are kept in memory by each worker process since its
+        start: they are not shared between the workers and are reset when a
+        worker is recycled.
+        """
+        return dict(REPLENISHMENT_LOCK_STATS)
 
     def run_replenishment(self, products=False):
-        """Run the replenishment for all potential products or only a selection"""
-        procurements = self._prepare_procurements(products)
+        """Run the replenishment for all potential products or only a selection
+
+        If a chunk size is configured, the products are replenished by chunks
+        and the cache is invalidated between chunks to keep the memory usage
+        bounded.
+        """
+        chunk_size = self._get_replenishment_chunk_size()
+        for procurements in self._iter_procurements(products, chunk_size):
+            self._run_procurements(procurements)
+            if chunk_size:
+                self.env.flush_all()
+                self.env.invalidate_all()
+
+    def _run_procurements(self, procurements):
         if not procurements:
             return
-        self.env["procurement.group"].with_context(from_orderpoint=True).run(
-            procurements, raise_user_error=False
-        )
+        # collects the moves confirmed by the procurements to assign them
+        self = self.with_context(location_orderpoint_move_ids=[])
+        with self._replenishment_phase("run_procurements") as phase:
+            phase["count"] = len(procurements)
+            if self._use_bulk_procurements():
+                procurements = self._run_procurements_bulk(procurements)
+            if procurements:
+                self.env["procurement.group"].with_context(from_orderpoint=True).run(
+                    procurements, raise_user_error=False
+                )
         self._after_replenishment()
 
-    def _prepare_to_assign_replenishment_move_domain(self):
-        """Returns a domain which selects moves created by a replenishment"""
+    @api.model
+    def _use_bulk_procurements(self):
+        """Returns True if the procurements of the orderpoints with a route
+        are run without procurement.group.run"""
+        return tools.str2bool(
+            self.env["ir.config_parameter"]
+            .sudo()
+            .get_param("stock_location_orderpoint.bulk_procurements", "0")
+        )
+
+    def _get_procurement_rule(self, procurement):
+        """Returns the rule of the route of the orderpoint applied to its
+        procurements, or an empty recordset if the rule could depend on the
+        product of the procurement
+        """
+        self.ensure_one()
+        rule = (
+            self.env["procurement.group"]
+            .with_context(from_orderpoint=True)
+            ._get_rule(
+                procurement.product_id, procurement.location_id, procurement.values
+            )
+        )
+        # the routes of the product are only searched when the route of the
+        # orderpoint has no rule for the location
+        if (
+            rule
+            and rule.route_id == self.route_id
+            and rule.location_dest_id == procurement.location_id
+        ):
+            return rule
+        return self.env["stock.rule"]
+
+    def _run_procurements_bulk(self, procurements):
+        """Runs the procurements of the orderpoints with a route like
+        procurement.group.run does, but resolving the rule once per orderpoint
+        instead of once per procurement. The rules then create and confirm the
+        moves of all their procurements at once.
+
+        Overrides of procurement.group.run are not applied to these
+        procurements.
+
+        :return: list of the procurements left to procurement.group.run
+        """
+        rules = {}
+        procurements_by_action = defaultdict(list)
+        remaining_procurements = []
+        for procurement in procurements:
+            orderpoint = self.browse(procurement.values.get("location_orderpoint_id"))
+            if not orderpoint.route_id or procurement.product_id.type not in (
+                "consu",
+                "product",
+            ):
+                remaining_procurements.append(procurement)
+                continue
+            procurement.values.setdefault(
+                "company_id", procurement.location_id.company_id
+            )
+            procurement.values.setdefault("priority", "0")
+            if orderpoint not in rules:
+                rules[orderpoint] = orderpoint._get_procurement_rule(procurement)
+            rule = rules[orderpoint]
+            action = "pull" if rule.action == "pull_push" else rule.action
+            if not rule or not hasattr(rule, "_run_%s" % action):
+                remaining_procurements.append(procurement)
+                continue
+            procurements_by_action[action].append((procurement, rule))
+        rule_obj = self.env["stock.rule"].with_context(from_orderpoint=True)
+        for action, rule_procurements in procurements_by_action.items():
+            getattr(rule_obj, "_run_%s" % action)(rule_procurements)
+        return remaining_procurements
+
+    @contextmanager
+    def _replenishment_phase(self, name):
+        """Measures a phase of the replenishment
+
+        Yields a dict in which the phase can set the number of records it
+        handled in the "count" key. On exit, the wall time and the number of
+        SQL queries of the phase are added and the dict is passed to
+        _notify_replenishment_phase.
+        """
+        values = {"phase": name, "orderpoint_ids": self.ids, "count": 0}
+        query_count = self.env.cr.sql_log_count
+        start = time.perf_counter()
+        yield values
+        values["time"] = time.perf_counter() - start
+        values["queries"] = self.env.cr.sql_log_count - query_count
+        self._notify_replenishment_phase(values)
+
+    def _notify_replenishment_phase(self, values):
+        """Hook called at the end of each phase of the replenishment
+
+        :param values: dict with the keys phase, orderpoint_ids, count,
+            time (in seconds) and queries
+        """
+        _perf_logger.info(
+            "stock.location.orderpoint replenishment phase=%s orderpoints=%s "
+            "count=%s time=%.6f queries=%s",
+            values["phase"],
+            len(values["orderpoint_ids"]),
+            values["count"],
+            values["time"],
+            values["queries"],
+        )
+        run_values = self.env.context.get("location_orderpoint_run_values")
+        if run_values is not None:
+            self.env["stock.location.orderpoint.run"]._add_phase(run_values, values)
+
+    def _prepare_to_assign_replenishment_move_domain(self, last_move_id=0):
+        """Returns a domain which selects moves created by a replenishment
+        of the orderpoints, of any orderpoint on an empty recordset
+
+        :param int last_move_id: only select the moves after this one
+        """
         domain = [
             ("state", "in", ["confirmed", "partially_available"]),
             ("procure_method", "=", "make_to_stock"),
-            ("location_orderpoint_id", "in", self.ids),
+            ("location_orderpoint_id", "in", self.ids)
+            if self
+            else ("location_orderpoint_id", "!=", False),
         ]
+        if last_move_id:
+            domain.append(("id", ">", last_move_id))
         return domain
 
-    def _assign_replenishment_moves(self):
-        """Assigns moves created by the orderpoints"""
+    def _assign_replenishment_moves(self, moves=None):
+        """Assigns the moves created or updated (e.g. merged) by the
+        replenishment of the orderpoints
+
+        :param moves: the moves of the current replenishment, by default all
+            the waiting moves of the orderpoints. The other moves are assigned
+            by _sweep_replenishment_moves.
+        """
         domain = self._prepare_to_assign_replenishment_move_domain()
-        moves_to_assign = self.env["stock.move"].search(
-            domain, order="priority desc, date asc, id asc"
+        if moves is not None:
+            domain = expression.AND([domain, [("id", "in", moves.ids)]])
+        with self._replenishment_phase("assign_moves") as phase:
+            moves_to_assign = self.env["stock.move"].search(
+                domain, order="priority desc, date asc, id asc"
+            )
+            self._assign_moves_by_chunk(moves_to_assign)
+            phase["count"] = len(moves_to_assign)
+
+    @api.model
+    def _get_assign_chunk_size(self):
+        return int(
+            self.env["ir.config_parameter"]
+            .sudo()
+            .get_param("stock_location_orderpoint.assign_chunk_size", 100)
         )
-        for moves_chunk in split_every(100, moves_to_assign.ids):
-            self.env["stock.move"].browse(moves_chunk)._action_assign()
+
+    @api.model
+    def _assign_moves_by_chunk(self, moves):
+        """Assigns the moves by chunks, each one in its own savepoint so that
+        an error on a chunk does not prevent the other ones to be assigned"""
+        for moves_chunk in split_every(self._get_assign_chunk_size(), moves.ids):
+            try:
+                with self.env.cr.savepoint():
+                    self.env["stock.move"].browse(moves_chunk)._action_assign()
+            except (UserError, ValidationError):
+                _logger.exception(
+                    "Unable to assign the replenishment moves %s", moves_chunk
+                )
 
     def _after_replenishment(self):
-        self._assign_replenishment_moves()
+        moves = self.env["stock.move"].browse(
+            set(self.env.context.get("location_orderpoint_move_ids", []))
+        )
+        self._assign_replenishment_moves(moves)
+
+    @api.model
+    def _sweep_replenishment_moves(self, limit=None):
+        """Tries to assign the replenishment moves left waiting availability
+
+        The moves are swept by pages of limit moves, each page starting after
+        the last move of the previous one. The cache is cleared between the
+        pages to keep the memory usage bounded.
+        """
+        if not limit:
+            limit = int(
+                self.env["ir.config_parameter"]
+                .sudo()
+                .get_param("stock_location_orderpoint.assign_sweep_limit", 1000)
+            )
+        last_move_id = 0
+        while True:
+            domain = self.browse()._prepare_to_assign_replenishment_move_domain(
+                last_move_id
+            )
+            moves = self.env["stock.move"].search(domain, order="id", limit=limit)
+            if not moves:
+                return
+            last_move_id = moves[-1].id
+            self._assign_moves_by_chunk(moves)
+            if len(moves) < limit:
+                return
+            self.env.flush_all()
+            self.env.invalidate_all()
 
     def _prepare_orderpoint_domain_location(self, location_ids, location_field=False):
         """
@@ -534,17 +1519,50 @@ class StockLocationOrderpoint(models.Model):
             result[orderpoint[location_field].parent_path].append(orderpoint.id)
         return result
 
+    @api.model
+    @tools.ormcache("trigger", "location_field")
+    def _get_ids_trie(self, trigger, location_field):
+        """Returns a trie of the orderpoint ids for the given trigger and
+        location_field, keyed on the segments of the locations parent paths
+
+        Each node is a dict whose ``None`` key holds the ids of the
+        orderpoints of the location and whose other keys are the ids
+        of the child locations.
+        """
+        trie = {}
+        for parent_path, ids in self._get_ids_by_parent_path(
+            trigger, location_field
+        ).items():
+            node = trie
+            for segment in parent_path.split("/")[:-1]:
+                node = node.setdefault(int(segment), {})
+            node.setdefault(None, []).extend(ids)
+        return trie
+
+    @api.model
+    def _get_orderpoint_ids_covering(self, location, trie):
+        """Returns the orderpoint ids of the trie on the location or its parents"""
+        ids = []
+        node = trie
+        for location_id in location._get_parent_path_ids():
+            node = node.get(location_id)
+            if node is None:
+                break
+            ids.extend(node.get(None, ()))
+        return ids
+
     @api.model
     def _get_orderpoints(self, trigger, locations=False, location_field="location_id"):
         """Returns orderpoints selected by trigger, locations and location_field"""
-        ids_by_parent_paths = self._get_ids_by_parent_path(trigger, location_field)
         ids = set()
         if locations:
+            if not isinstance(locations, models.BaseModel):
+                locations = self.env["stock.location"].browse(locations)
+            trie = self._get_ids_trie(trigger, location_field)
             for location in locations:
-                for parent_path in ids_by_parent_paths:
-                    if location.parent_path.startswith(parent_path):
-                        ids.update(ids_by_parent_paths[parent_path])
+                ids.update(self._get_orderpoint_ids_covering(location, trie))
         else:
+            ids_by_parent_paths = self._get_ids_by_parent_path(trigger, location_field)
             # ids_by_parent_paths.values() is a list of ids. We need to flatten it
             ids = set().union(*ids_by_parent_paths.values())
         return self.browse(list(ids))
@@ -575,8 +1593,120 @@ class StockLocationOrderpoint(models.Model):
         )
         if not orderpoints:
             return self.env["stock.move"]
-        moves = moves.filtered_domain(self._get_moves_domain(orderpoints.ids))
-        return moves
+        # the domain is composed of cached fragments, compiling it only
+        # creates a few closures
+        predicate = self._compile_domain_predicate(
+            self.env["stock.move"], self._get_moves_domain(orderpoints.ids)
+        )
+        return moves.filtered(predicate)
+
+    @api.model
+    def _compile_domain_predicate(self, model, domain):
+        """Compiles a domain into a python predicate evaluated on records of
+        the given model, giving the same result as `filtered_domain`.
+
+        The predicate does not keep any reference to the environment, so it
+        can be cached. The leaves which cannot be compiled are evaluated with
+        `filtered_domain` on each record.
+        """
+        stack = []
+        for token in reversed(expression.normalize_domain(domain)):
+            if token == expression.AND_OPERATOR:
+                left, right = stack.pop(), stack.pop()
+                stack.append(
+                    lambda record, left=left, right=right: left(record)
+                    and right(record)
+                )
+            elif token == expression.OR_OPERATOR:
+                left, right = stack.pop(), stack.pop()
+                stack.append(
+                    lambda record, left=left, right=right: left(record) or right(record)
+                )
+            elif token == expression.NOT_OPERATOR:
+                operand = stack.pop()
+                stack.append(lambda record, operand=operand: not operand(record))
+            else:
+                stack.append(self._compile_domain_leaf(model, token))
+        return stack[0]
+
+    @api.model
+    def _compile_domain_leaf(self, model, leaf):
+        """Returns a predicate for a domain leaf. See _compile_domain_predicate"""
+        leaf = tuple(leaf)
+        if leaf == expression.TRUE_LEAF:
+            return lambda record: True
+        if leaf == expression.FALSE_LEAF:
+            return lambda record: False
+        fname, operator, value = leaf
+        field = model._fields.get(fname)
+        predicate = None
+        if not field:
+            pass
+        elif field.type in ("one2many", "many2many"):
+            if operator == "=" and value is False:
+                predicate = lambda record: not record[fname]  # noqa: E731
+        elif field.type == "many2one" and operator == "child_of":
+            ids = {value} if isinstance(value, int) else set(value)
+            predicate = lambda record: not ids.isdisjoint(  # noqa: E731
+                record[fname]._get_parent_path_ids() if record[fname] else ()
+            )
+        elif field.type == "many2one":
+            if isinstance(value, int) or (
+                isinstance(value, (list, tuple))
+                and all(isinstance(item, int) for item in value)
+            ):
+                predicate = self._compile_domain_leaf_operator(
+                    lambda record: record[fname].id, operator, value
+                )
+        elif field.type in ("datetime", "date"):
+            if isinstance(value, str):
+                value = (
+                    fields.Datetime.to_datetime(value)
+                    if field.type == "datetime"
+                    else fields.Date.to_date(value)
+                )
+            predicate = self._compile_domain_leaf_operator(
+                lambda record: record[fname], operator, value
+            )
+        elif field.type in ("selection", "char", "integer", "float", "boolean"):
+            predicate = self._compile_domain_leaf_operator(
+                lambda record: record[fname], operator, value
+            )
+        if predicate is None:
+            return lambda record: bool(record.filtered_domain([leaf]))
+        return predicate
+
+    @api.model
+    def _compile_domain_leaf_operator(self, get_value, operator, value):
+        """Returns a predicate comparing the value returned by get_value
+        with the value of a domain leaf, or None if the operator is not
+        supported
+        """
+        if operator in ("=", "!=") and value is False:
+            if operator == "=":
+                return lambda record: not get_value(record)
+            return lambda record: bool(get_value(record))
+        if operator == "=":
+            return lambda record: get_value(record) == value
+        if operator == "!=":
+            return lambda record: get_value(record) != value
+        if operator in ("in", "not in"):
+            values = set(value)
+            if operator == "in":
+                return lambda record: get_value(record) in values
+            return lambda record: get_value(record) not in values
+        compare = COMPARATORS.get(operator)
+        if compare is None or value is False:
+            return None
+
+        def predicate(record):
+            record_value = get_value(record)
+            # like in SQL, empty values never match
+            if record_value is False or record_value is None:
+                return False
+            return compare(record_value, value)
+
+        return predicate
 
     @api.model
     def run_auto_replenishment(self, products, locations, location_field=False):
@@ -591,37 +1721,174 @@ class StockLocationOrderpoint(models.Model):
         if not locations or not products:
             return
         self = self._get_orderpoints("auto", locations, location_field)
-        self.run_replenishment(products)
+        if not self:
+            return
+        with self.env["stock.location.orderpoint.run"]._track(
+            self, "auto"
+        ) as orderpoints:
+            orderpoints.run_replenishment(products)
 
     @api.model
     def run_cron_replenishment(self, location_ids=False):
+        """Run the replenishment of the scheduled orderpoints
+
+        If the system parameter stock_location_orderpoint.cron_shard_by is
+        set to warehouse or location, the orderpoints are split into shards
+        replenished by parallel jobs.
+        """
         self = self._get_orderpoints("cron", location_ids)
-        self.run_replenishment()
+        shard_by = self._get_cron_shard_by()
+        if shard_by:
+            for shard in self._split_cron_shards(shard_by):
+                shard._enqueue_cron_replenishment().delay()
+            return
+        self._run_cron_replenishment()
+
+    def _run_cron_replenishment(self):
+        with self.env["stock.location.orderpoint.run"]._track(
+            self, "cron"
+        ) as orderpoints:
+            # the orderpoints are replenished by several calls, take all
+            # their locks at once, in the same order as the other ones
+            orderpoints._lock_replenishment()
+            backfill_orderpoints = orderpoints.filtered(
+                lambda orderpoint: not orderpoint.last_cron_execution
+            )
+            if orderpoints - backfill_orderpoints:
+                (orderpoints - backfill_orderpoints).run_replenishment()
+            if backfill_orderpoints:
+                backfill_orderpoints._run_cron_backfill()
         # use the current transaction date to ensure that orderpoints run
         # in the same transaction have the same last_cron_execution and are
         # always grouped together
-        self.write({"last_cron_execution": self.env.cr.now()})
+        date = self.env.cr.now()
+        write_date_orderpoints = self.filtered(
+            lambda orderpoint: orderpoint.cron_move_selection == "write_date"
+        )
+        (self - write_date_orderpoints)._set_last_cron_execution(date)
+        if write_date_orderpoints:
+            # the moves written by the transactions still running are not
+            # visible yet, start the next execution from the oldest one
+            oldest_transaction_start = self._get_oldest_transaction_start()
+            if oldest_transaction_start:
+                date = min(date, oldest_transaction_start)
+            write_date_orderpoints._set_last_cron_execution(date)
+
+    @api.model
+    def _get_cron_backfill_config(self):
+        """Returns the period processed by the first cron execution of an
+        orderpoint and the size of the windows it is processed by"""
+        get_param = self.env["ir.config_parameter"].sudo().get_param
+        return (
+            timedelta(
+                days=int(get_param("stock_location_orderpoint.cron_backfill_days", 7))
+            ),
+            timedelta(
+                hours=int(
+                    get_param(
+                        "stock_location_orderpoint.cron_backfill_window_hours", 24
+                    )
+                )
+            ),
+        )
+
+    def _run_cron_backfill(self):
+        """Runs the first cron execution of the orderpoints by windows of moves
+
+        Each window is replenished separately to bound the number of moves
+        read at once. The last window has no upper bound.
+        """
+        period, window = self._get_cron_backfill_config()
+        date_to = self.env.cr.now()
+        date_from = date_to - period
+        while True:
+            window_end = date_from + window if window else date_to
+            self._set_last_cron_execution(date_from)
+            if window_end >= date_to:
+                self.run_replenishment()
+                break
+            self.with_context(
+                location_orderpoint_cron_date_to=window_end
+            ).run_replenishment()
+            date_from = window_end
+
+    def run_cron_replenishment_shard(self):
+        """Run the replenishment of a shard of scheduled orderpoints"""
+        self.exists()._run_cron_replenishment()
+
+    @api.model
+    def _get_cron_shard_by(self):
+        return (
+            self.env["ir.config_parameter"]
+            .sudo()
+            .get_param("stock_location_orderpoint.cron_shard_by", "")
+        )
+
+    def _get_cron_shard_key(self, shard_by):
+        """Returns the record identifying the shard of the orderpoint"""
+        self.ensure_one()
+        if shard_by == "warehouse":
+            return self.location_id.warehouse_id
+        return self.location_id
+
+    def _split_cron_shards(self, shard_by):
+        """Returns an iterator of orderpoints with the same shard key"""
+        shards = defaultdict(list)
+        for orderpoint in self:
+            shards[orderpoint._get_cron_shard_key(shard_by)].append(orderpoint.id)
+        for ids in shards.values():
+            yield self.browse(ids)
+
+    def _enqueue_cron_replenishment(self, **job_options):
+        """Enqueue a job stock.location.orderpoint.run_cron_replenishment_shard()
+
+        Can be extended to pass different options to the job (priority, ...).
+        The usage of `.setdefault` allows to override the options set by default.
+
+        return: a `Job` instance
+        """
+        job_options = job_options.copy()
+        job_options.setdefault(
+            "description",
+            _("Run the scheduled replenishment of %(locations)s")
+            % {"locations": ", ".join(self.location_id.mapped("display_name"))},
+        )
+        # do not enqueue a shard twice while it is not run
+        job_options.setdefault("identity_key", identity_exact)
+        return self.delayable(**job_options).run_cron_replenishment_shard()
 
     def _clear_caches(self):
         self._get_ids_by_parent_path.clear_cache(self)
-        self._get_consuming_moves_domain_for_ids.clear_cache(self)
-        self._get_replenishment_moves_domain_for_ids.clear_cache(self)
+        self._get_ids_trie.clear_cache(self)
+        self._get_moves_domain_fragment.clear_cache(self)
+        self.env[
+            "stock.location.orderpoint.ledger"
+        ]._get_ledger_location_ids.clear_cache(self)
 
     @api.model_create_multi
     def create(self, vals_list):
         self._clear_caches()
-        return super().create(vals_list)
+        orderpoints = super().create(vals_list)
+        self.env["stock.location.orderpoint.ledger"]._update_locations()
+        return orderpoints
 
     def write(self, vals):
         # if we only update values that change the group_by_domain
         moves_domain_caches_update_fields = self._get_group_by_domain_config()
-        if any(field in vals for field in moves_domain_caches_update_fields):
-            self._get_consuming_moves_domain_for_ids.clear_cache(self)
-            self._get_replenishment_moves_domain_for_ids.clear_cache(self)
-        else:
-            self._clear_caches()
-        return super().write(vals)
+        if all(field in moves_domain_caches_update_fields for field in vals):
+            # the orderpoints get a new group key, no domain cache to clear,
+            # but the orderpoints by location are cached by trigger
+            if "trigger" in vals:
+                self._get_ids_by_parent_path.clear_cache(self)
+                self._get_ids_trie.clear_cache(self)
+            return super().write(vals)
+        self._clear_caches()
+        res = super().write(vals)
+        self.env["stock.location.orderpoint.ledger"]._update_locations()
+        return res
 
     def unlink(self):
         self._clear_caches()
-        return super().unlink()
+        res = super().unlink()
+        self.env["stock.location.orderpoint.ledger"]._update_locations()
+        return res
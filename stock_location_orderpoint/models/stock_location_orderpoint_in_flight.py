@@ -0,0 +1,130 @@
+# Copyright 2026 Michael Tietz (MT Software) <mtietz@mt-software.de>
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+from contextlib import closing, contextmanager
+
+from psycopg2 import sql
+
+from odoo import api, fields, models, sql_db
+
+
+class StockLocationOrderpointInFlight(models.Model):
+    """Quantities replenished by the location orderpoints per transaction
+
+    Each transaction inserts the quantities it replenishes with its own
+    records, committed with its replenishment moves, so concurrent
+    transactions never conflict on the same row. The records are read with
+    a new snapshot, so that a replenishment sees the quantities replenished
+    by the transactions committed since its own snapshot was taken (e.g.
+    while it was waiting for the replenishment locks) and whose moves it
+    cannot see, and does not replenish the same shortage twice.
+    """
+
+    _name = "stock.location.orderpoint.in.flight"
+    _description = "Stock location orderpoint quantities in flight"
+    _log_access = False
+
+    orderpoint_id = fields.Many2one(
+        "stock.location.orderpoint", required=True, ondelete="cascade", readonly=True
+    )
+    product_id = fields.Many2one(
+        "product.product", required=True, ondelete="cascade", readonly=True
+    )
+    quantity = fields.Float(readonly=True)
+    transaction_id = fields.Char(
+        required=True,
+        readonly=True,
+        help="PostgreSQL id of the transaction which replenished the quantity",
+    )
+    date = fields.Datetime(required=True, readonly=True)
+
+    _sql_constraints = [
+        (
+            "orderpoint_product_transaction_unique",
+            "unique(orderpoint_id, product_id, transaction_id)",
+            "The quantity in flight must be unique per orderpoint, product "
+            "and transaction",
+        )
+    ]
+
+    @api.model
+    @contextmanager
+    def _get_snapshot_cursor(self):
+        """Yields a cursor with a new snapshot, closed without commit"""
+        with closing(sql_db.db_connect(self.env.cr.dbname).cursor()) as cr:
+            yield cr
+
+    @api.model
+    def _get_quantities(self, orderpoints, products):
+        """Returns the quantities replenished by the other transactions which
+        are not visible in the snapshot of the current transaction
+
+        :return: dict {(orderpoint_id, product_id): quantity}
+        """
+        if not orderpoints or not products:
+            return {}
+        self.flush_model()
+        self.env.cr.execute("SELECT txid_current_snapshot()::text, txid_current()")
+        snapshot, transaction_id = self.env.cr.fetchone()
+        with self._get_snapshot_cursor() as cr:
+            cr.execute(
+                """
+                SELECT orderpoint_id, product_id, SUM(quantity)
+                FROM stock_location_orderpoint_in_flight
+                WHERE orderpoint_id IN %s
+                    AND product_id IN %s
+                    AND transaction_id::bigint != %s
+                    AND NOT txid_visible_in_snapshot(
+                        transaction_id::bigint, %s::txid_snapshot
+                    )
+                    AND txid_status(transaction_id::bigint)
+                        IS DISTINCT FROM 'aborted'
+                GROUP BY orderpoint_id, product_id
+                """,
+                (tuple(orderpoints.ids), tuple(products.ids), transaction_id, snapshot),
+            )
+            return {
+                (orderpoint_id, product_id): quantity
+                for orderpoint_id, product_id, quantity in cr.fetchall()
+            }
+
+    @api.model
+    def _register_quantities(self, quantities):
+        """Adds the quantities replenished by the current transaction
+
+        :param quantities: dict {(orderpoint_id, product_id): quantity}
+        """
+        if not quantities:
+            return
+        self.env.cr.execute("SELECT txid_current()")
+        transaction_id = str(self.env.cr.fetchone()[0])
+        date = self.env.cr.now()
+        values = [
+            (orderpoint_id, product_id, quantity, transaction_id, date)
+            for (orderpoint_id, product_id), quantity in quantities.items()
+        ]
+        self.flush_model()
+        self.env.cr.execute(
+            sql.SQL(
+                """
+                INSERT INTO stock_location_orderpoint_in_flight
+                    (orderpoint_id, product_id, quantity, transaction_id, date)
+                VALUES {}
+                ON CONFLICT (orderpoint_id, product_id, transaction_id)
+                DO UPDATE SET quantity =
+                    stock_location_orderpoint_in_flight.quantity + EXCLUDED.quantity
+                """
+            ).format(sql.SQL(", ").join([sql.Placeholder()] * len(values))),
+            values,
+        )
+        self.invalidate_model()
+
+    @api.autovacuum
+    def _gc_in_flight(self):
+        """Deletes the quantities of the aborted and old transactions"""
+        self.env.cr.execute(
+            """
+            DELETE FROM stock_location_orderpoint_in_flight
+            WHERE date < (now() at time zone 'UTC') - interval '1 day'
+                OR txid_status(transaction_id::bigint) = 'aborted'
+            """
+        )
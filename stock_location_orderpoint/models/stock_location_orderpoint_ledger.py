@@ -0,0 +1,252 @@
+# Copyright 2026 Michael Tietz (MT Software) <mtietz@mt-software.de>
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+from collections import defaultdict
+
+from odoo import api, fields, models, tools
+from odoo.tools.sql import create_index
+
+from .stock_location_orderpoint import MOVE_TODO_STATES
+
+
+class StockLocationOrderpointLedger(models.Model):
+    """Forecast ledger of the location orderpoints
+
+    Each record is a delta of the on hand, incoming and outgoing quantities
+    of a product on a location used by an orderpoint with the forecast ledger
+    enabled. The deltas are only inserted, never updated, so that concurrent
+    transactions never conflict on the same row. They are summed up when
+    reading and regularly compacted into one record per location and product.
+    """
+
+    _name = "stock.location.orderpoint.ledger"
+    _description = "Stock location orderpoint forecast ledger"
+    _log_access = False
+
+    location_id = fields.Many2one(
+        "stock.location", required=True, ondelete="cascade", readonly=True
+    )
+    product_id = fields.Many2one(
+        "product.product", required=True, ondelete="cascade", readonly=True
+    )
+    qty_available = fields.Float(readonly=True)
+    incoming_qty = fields.Float(readonly=True)
+    outgoing_qty = fields.Float(readonly=True)
+
+    def init(self):
+        create_index(
+            self._cr,
+            "stock_location_orderpoint_ledger_location_product_index",
+            self._table,
+            ["location_id", "product_id"],
+        )
+
+    @api.model
+    @tools.ormcache()
+    def _get_ledger_location_ids(self):
+        """Returns the ids of the locations tracked by the ledger"""
+        orderpoints = (
+            self.env["stock.location.orderpoint"]
+            .sudo()
+            .search([("use_forecast_ledger", "=", True)])
+        )
+        return frozenset((orderpoints.location_id | orderpoints.location_src_id).ids)
+
+    @api.model
+    def _can_compute_quantities(self, locations, products):
+        """Returns True if the quantities of the given products on the given
+        locations can be read from the ledger
+        """
+        context = products.env.context
+        if context.get("excluded_location_ids") or context.get(
+            "excluded_location_domain"
+        ):
+            return False
+        if not self._get_ledger_location_ids().issuperset(locations.ids):
+            return False
+        # the ledger is initialized when the orderpoints are configured, never
+        # when reading the quantities, not to lock the locations
+        return all(
+            location.location_orderpoint_ledger_initialized
+            for location in locations.sudo()
+        )
+
+    @api.model
+    def _get_quantities_totals(self, locations, products):
+        """Returns the quantities of the given products on the given locations
+
+        :return: dict {(location_id, product_id): {qty_available,
+            incoming_qty, outgoing_qty}} of unrounded quantities
+        """
+        totals = defaultdict(lambda: defaultdict(float))
+        for res in self.sudo().read_group(
+            [
+                ("location_id", "in", locations.ids),
+                ("product_id", "in", products.ids),
+            ],
+            ["qty_available:sum", "incoming_qty:sum", "outgoing_qty:sum"],
+            ["location_id", "product_id"],
+            orderby="id",
+            lazy=False,
+        ):
+            quantities = totals[(res["location_id"][0], res["product_id"][0])]
+            for field in ("qty_available", "incoming_qty", "outgoing_qty"):
+                quantities[field] = res[field]
+        return totals
+
+    @api.model
+    def _initialize_locations(self, locations):
+        """(Re)initializes the ledger of the given locations
+
+        The existing deltas visible by the current transaction are replaced by
+        the current quantities computed from the quants and the moves. Deltas
+        of concurrent transactions are not visible thus neither removed nor
+        included in the current quantities.
+        """
+        if not locations:
+            return
+        self._delete_locations(locations)
+        self._create_deltas(
+            self.env["stock.location.orderpoint"]._get_quantities_totals(locations)
+        )
+        locations.sudo().write({"location_orderpoint_ledger_initialized": True})
+
+    @api.model
+    def _initialize_new_locations(self):
+        """Initializes the ledger of the locations used by an orderpoint with
+        the forecast ledger enabled which are not yet initialized
+        """
+        self._initialize_locations(
+            self.env["stock.location"]
+            .sudo()
+            .search(
+                [
+                    ("location_orderpoint_ledger_initialized", "=", False),
+                    ("id", "in", list(self._get_ledger_location_ids())),
+                ]
+            )
+        )
+
+    @api.model
+    def _update_locations(self):
+        """Drops the ledger of the locations no longer used and initializes
+        the ledger of the new ones"""
+        self._reset_unused_locations()
+        self._initialize_new_locations()
+
+    @api.model
+    def _reset_unused_locations(self):
+        """Drops the ledger of the locations no longer used by an orderpoint
+        with the forecast ledger enabled
+        """
+        locations = (
+            self.env["stock.location"]
+            .sudo()
+            .search(
+                [
+                    ("location_orderpoint_ledger_initialized", "=", True),
+                    ("id", "not in", list(self._get_ledger_location_ids())),
+                ]
+            )
+        )
+        if not locations:
+            return
+        self._delete_locations(locations)
+        locations.write({"location_orderpoint_ledger_initialized": False})
+
+    @api.model
+    def _delete_locations(self, locations):
+        self.flush_model()
+        self.env.cr.execute(
+            "DELETE FROM stock_location_orderpoint_ledger WHERE location_id IN %s",
+            (tuple(locations.ids),),
+        )
+        self.invalidate_model()
+
+    @api.model
+    def _new_deltas(self):
+        return defaultdict(lambda: defaultdict(float))
+
+    @api.model
+    def _add_move_deltas(self, deltas, moves, sign=1):
+        """Adds the incoming and outgoing quantities of the given moves
+        on the tracked locations to the deltas
+        """
+        ledger_location_ids = self._get_ledger_location_ids()
+        for move in moves:
+            if move.state not in MOVE_TODO_STATES:
+                continue
+            src_location_ids = ledger_location_ids.intersection(
+                move.location_id._get_parent_path_ids()
+            )
+            dest_location_ids = ledger_location_ids.intersection(
+                move.location_dest_id._get_parent_path_ids()
+            )
+            product_qty = sign * move.product_qty
+            for location_id in dest_location_ids - src_location_ids:
+                deltas[(location_id, move.product_id.id)]["incoming_qty"] += product_qty
+            for location_id in src_location_ids - dest_location_ids:
+                deltas[(location_id, move.product_id.id)]["outgoing_qty"] += product_qty
+        return deltas
+
+    @api.model
+    def _add_quant_deltas(self, deltas, quants, sign=1):
+        """Adds the on hand quantities of the given quants
+        on the tracked locations to the deltas
+        """
+        ledger_location_ids = self._get_ledger_location_ids()
+        for quant in quants:
+            for location_id in ledger_location_ids.intersection(
+                quant.location_id._get_parent_path_ids()
+            ):
+                deltas[(location_id, quant.product_id.id)]["qty_available"] += (
+                    sign * quant.quantity
+                )
+        return deltas
+
+    @api.model
+    def _create_deltas(self, deltas):
+        vals_list = [
+            dict(quantities, location_id=location_id, product_id=product_id)
+            for (location_id, product_id), quantities in deltas.items()
+            if any(quantities.values())
+        ]
+        if vals_list:
+            self.sudo().create(vals_list)
+
+    @api.model
+    def _compact(self):
+        """Merges all the deltas visible by the current transaction
+        into one record per location and product
+        """
+        self.flush_model()
+        self.env.cr.execute(
+            """
+            WITH deleted AS (
+                DELETE FROM stock_location_orderpoint_ledger
+                RETURNING
+                    location_id, product_id, qty_available, incoming_qty, outgoing_qty
+            )
+            INSERT INTO stock_location_orderpoint_ledger
+                (location_id, product_id, qty_available, incoming_qty, outgoing_qty)
+            SELECT
+                location_id,
+                product_id,
+                SUM(qty_available),
+                SUM(incoming_qty),
+                SUM(outgoing_qty)
+            FROM deleted
+            GROUP BY location_id, product_id
+            HAVING
+                SUM(qty_available) != 0
+                OR SUM(incoming_qty) != 0
+                OR SUM(outgoing_qty) != 0
+            """
+        )
+        self.invalidate_model()
+
+    @api.autovacuum
+    def _gc_compact_ledger(self):
+        self._compact()
+        # e.g. the locations tracked before the ledger was initialized on the
+        # configuration of the orderpoints
+        self._initialize_new_locations()
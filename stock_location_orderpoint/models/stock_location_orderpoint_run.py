@@ -0,0 +1,174 @@
+# Copyright 2026 Michael Tietz (MT Software) <mtietz@mt-software.de>
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+
+from odoo import SUPERUSER_ID, api, fields, models
+
+from odoo.addons.queue_job.exception import RetryableJobError
+
+
+class StockLocationOrderpointRun(models.Model):
+    """History of the cron and auto replenishments of the location orderpoints"""
+
+    _name = "stock.location.orderpoint.run"
+    _description = "Stock location orderpoint replenishment run"
+    _order = "date_start desc, id desc"
+    _rec_name = "date_start"
+
+    date_start = fields.Datetime(required=True, readonly=True, index=True)
+    trigger = fields.Selection(
+        [
+            ("auto", "Auto/realtime"),
+            ("manual", "Manual"),
+            ("cron", "Scheduled"),
+        ],
+        required=True,
+        readonly=True,
+    )
+    state = fields.Selection(
+        [("done", "Done"), ("failed", "Failed")],
+        required=True,
+        readonly=True,
+    )
+    orderpoint_ids = fields.Many2many(
+        "stock.location.orderpoint",
+        string="Orderpoints",
+        readonly=True,
+    )
+    product_count = fields.Integer(
+        string="Products Scanned",
+        readonly=True,
+    )
+    procurement_count = fields.Integer(
+        string="Procurements",
+        readonly=True,
+    )
+    duration = fields.Float(readonly=True, help="Duration of the run in seconds")
+    query_count = fields.Integer(string="Queries", readonly=True)
+    error = fields.Text(readonly=True)
+    phase_ids = fields.One2many(
+        "stock.location.orderpoint.run.phase",
+        "run_id",
+        string="Phases",
+        readonly=True,
+    )
+
+    @api.model
+    @contextmanager
+    def _track(self, orderpoints, trigger):
+        """Records a run of the replenishment of the given orderpoints
+
+        Yields the orderpoints with a context collecting the replenishment
+        phases. A failed run is recorded in a new transaction (see
+        _create_failed_run), as the current one is rolled back by the cron or
+        the job. A retried job is not a failure and is not recorded.
+        """
+        values = {
+            "date_start": fields.Datetime.now(),
+            "trigger": trigger,
+            "orderpoint_ids": [(6, 0, orderpoints.ids)],
+            "product_count": 0,
+            "procurement_count": 0,
+            "query_count": 0,
+            "phase_ids": [],
+        }
+        start = time.perf_counter()
+        try:
+            yield orderpoints.with_context(location_orderpoint_run_values=values)
+        except RetryableJobError:
+            raise
+        except Exception as error:
+            values.update(
+                state="failed",
+                error=str(error),
+                duration=time.perf_counter() - start,
+            )
+            self._create_failed_run(values)
+            raise
+        values.update(state="done", duration=time.perf_counter() - start)
+        self.sudo().create(values)
+
+    @api.model
+    def _create_failed_run(self, values):
+        """Records a failed run in a new transaction, committed whatever the
+        outcome of the current one
+
+        The orderpoints created by the current transaction are not visible
+        from the new one and are not linked to the run.
+        """
+        with self.env.registry.cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            orderpoint_ids = values["orderpoint_ids"][0][2]
+            orderpoints = (
+                env["stock.location.orderpoint"].browse(orderpoint_ids).exists()
+            )
+            env[self._name].create(
+                dict(values, orderpoint_ids=[(6, 0, orderpoints.ids)])
+            )
+
+    @api.model
+    def _add_phase(self, values, phase_values):
+        """Adds the values of a replenishment phase to the run values"""
+        values["query_count"] += phase_values["queries"]
+        if phase_values["phase"] == "find_moves":
+            values["product_count"] += phase_values.get("product_count", 0)
+        elif phase_values["phase"] == "run_procurements":
+            values["procurement_count"] += phase_values["count"]
+        values["phase_ids"].append(
+            (
+                0,
+                0,
+                {
+                    "name": phase_values["phase"],
+                    "count": phase_values["count"],
+                    "duration": phase_values["time"],
+                    "query_count": phase_values["queries"],
+                },
+            )
+        )
+
+    @api.model
+    def _get_retention_days(self):
+        return int(
+            self.env["ir.config_parameter"]
+            .sudo()
+            .get_param("stock_location_orderpoint.run_retention_days", 30)
+        )
+
+    @api.autovacuum
+    def _gc_runs(self):
+        """Deletes the runs older than the retention period"""
+        retention_days = self._get_retention_days()
+        if retention_days <= 0:
+            return
+        self.search(
+            [
+                (
+                    "date_start",
+                    "<",
+                    fields.Datetime.now() - timedelta(days=retention_days),
+                )
+            ]
+        ).unlink()
+
+
+class StockLocationOrderpointRunPhase(models.Model):
+    _name = "stock.location.orderpoint.run.phase"
+    _description = "Stock location orderpoint replenishment run phase"
+    _order = "id"
+
+    run_id = fields.Many2one(
+        "stock.location.orderpoint.run",
+        required=True,
+        ondelete="cascade",
+        readonly=True,
+        index=True,
+    )
+    name = fields.Char(string="Phase", required=True, readonly=True)
+    count = fields.Integer(
+        string="Records", readonly=True, help="Number of records handled"
+    )
+    duration = fields.Float(readonly=True, help="Duration of the phase in seconds")
+    query_count = fields.Integer(string="Queries", readonly=True)
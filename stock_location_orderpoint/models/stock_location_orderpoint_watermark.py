@@ -0,0 +1,77 @@
+# Copyright 2026 Michael Tietz (MT Software) <mtietz@mt-software.de>
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+from psycopg2 import sql
+
+from odoo import api, fields, models
+
+
+class StockLocationOrderpointWatermark(models.Model):
+    """Progress of the cron replenishment of the location orderpoints
+
+    The progress is stored outside of the orderpoints, so that each cron
+    execution does not write on the orderpoints, which would clear the caches
+    depending on their configuration in every worker.
+    """
+
+    _name = "stock.location.orderpoint.watermark"
+    _description = "Stock location orderpoint cron progress"
+    _log_access = False
+
+    orderpoint_id = fields.Many2one(
+        "stock.location.orderpoint", required=True, ondelete="cascade", readonly=True
+    )
+    last_cron_execution = fields.Datetime(readonly=True)
+
+    _sql_constraints = [
+        (
+            "orderpoint_unique",
+            "unique(orderpoint_id)",
+            "The cron progress must be unique per orderpoint",
+        )
+    ]
+
+    @api.model
+    def _get_last_cron_executions(self, orderpoints):
+        """Returns the last cron execution of the given orderpoints
+
+        :return: dict {orderpoint_id: last_cron_execution}
+        """
+        orderpoint_ids = tuple(
+            orderpoint_id for orderpoint_id in orderpoints.ids if orderpoint_id
+        )
+        if not orderpoint_ids:
+            return {}
+        self.flush_model()
+        self.env.cr.execute(
+            """
+            SELECT orderpoint_id, last_cron_execution
+            FROM stock_location_orderpoint_watermark
+            WHERE orderpoint_id IN %s
+            """,
+            (orderpoint_ids,),
+        )
+        return dict(self.env.cr.fetchall())
+
+    @api.model
+    def _set_last_cron_execution(self, orderpoints, date):
+        """Sets the last cron execution of the given orderpoints"""
+        orderpoint_ids = [
+            orderpoint_id for orderpoint_id in orderpoints.ids if orderpoint_id
+        ]
+        if not orderpoint_ids:
+            return
+        values = [(orderpoint_id, date or None) for orderpoint_id in orderpoint_ids]
+        self.flush_model()
+        self.env.cr.execute(
+            sql.SQL(
+                """
+                INSERT INTO stock_location_orderpoint_watermark
+                    (orderpoint_id, last_cron_execution)
+                VALUES {}
+                ON CONFLICT (orderpoint_id)
+                DO UPDATE SET last_cron_execution = EXCLUDED.last_cron_execution
+                """
+            ).format(sql.SQL(", ").join([sql.Placeholder()] * len(values))),
+            values,
+        )
+        self.invalidate_model(["last_cron_execution"])
@@ -1,11 +1,43 @@
 # Copyright 2023 Michael Tietz (MT Software) <mtietz@mt-software.de>
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+import hashlib
 from collections import defaultdict
 
-from odoo import _, fields, models
-from odoo.tools import ormcache
+from psycopg2 import OperationalError
 
-from odoo.addons.queue_job.job import identity_exact
+from odoo import _, api, fields, models, tools
+from odoo.tools import mute_logger
+from odoo.tools.sql import column_exists, create_column, create_index
+
+from odoo.addons.queue_job.job import Job
+
+AUTO_REPLENISHMENT_BUFFER_KEY = "stock_location_orderpoint.auto_replenishment"
+
+
+def _auto_replenishment_identity_prefix(locations, location_field):
+    hasher = hashlib.sha1()
+    hasher.update(b"stock.location.orderpoint.run_auto_replenishment")
+    hasher.update(str(sorted(locations.ids)).encode("utf-8"))
+    hasher.update(str(location_field).encode("utf-8"))
+    return hasher.hexdigest()
+
+
+def _auto_replenishment_identity(products, locations, location_field):
+    return "%s-%s" % (
+        _auto_replenishment_identity_prefix(locations, location_field),
+        hashlib.sha1(str(sorted(products.ids)).encode("utf-8")).hexdigest(),
+    )
+
+
+def identity_auto_replenishment(job_):
+    """Identity key of the stock.location.orderpoint.run_auto_replenishment jobs
+
+    The key is made of a prefix identifying the locations and the location
+    field to replenish, and of a suffix identifying the products. The prefix
+    allows to find the pending job into which new products can be merged
+    while the whole key avoids to enqueue twice the same job.
+    """
+    return _auto_replenishment_identity(*job_.args)
 
 
 class StockMove(models.Model):
@@ -15,11 +47,112 @@ class StockMove(models.Model):
         "stock.location.orderpoint", "Stock location orderpoint", index=True
     )
 
-    @ormcache("self", "product")
-    def _get_location_orderpoint_replenishment_date(self, product):
-        return min(
-            self.filtered(lambda move: move.product_id == product).mapped("date")
+    has_move_orig = fields.Boolean(
+        compute="_compute_has_move_orig_dest",
+        store=True,
+        help="Technical field used by the location orderpoints to select the "
+        "moves without origin moves without joining the chained moves",
+    )
+    has_move_dest = fields.Boolean(
+        compute="_compute_has_move_orig_dest",
+        store=True,
+        help="Technical field used by the location orderpoints to select the "
+        "moves without destination moves without joining the chained moves",
+    )
+
+    def _auto_init(self):
+        # fill the columns with one query instead of computing the fields
+        # of all the existing moves
+        if not column_exists(self.env.cr, self._table, "has_move_orig"):
+            create_column(self.env.cr, self._table, "has_move_orig", "boolean")
+            create_column(self.env.cr, self._table, "has_move_dest", "boolean")
+            self.env.cr.execute(
+                """
+                UPDATE stock_move move
+                SET has_move_orig = EXISTS(
+                        SELECT 1 FROM stock_move_move_rel rel
+                        WHERE rel.move_dest_id = move.id
+                    ),
+                    has_move_dest = EXISTS(
+                        SELECT 1 FROM stock_move_move_rel rel
+                        WHERE rel.move_orig_id = move.id
+                    )
+                """
+            )
+        return super()._auto_init()
+
+    def init(self):
+        # used by the scheduled location orderpoints selecting the moves by
+        # last update, only created on demand as it is updated on each write
+        # of a move
+        if tools.str2bool(
+            self.env["ir.config_parameter"]
+            .sudo()
+            .get_param("stock_location_orderpoint.cron_write_date_index", "0")
+        ):
+            create_index(
+                self._cr,
+                "stock_move_write_date_index",
+                self._table,
+                ["write_date"],
+            )
+        # match the consuming and replenishment moves domains of the
+        # location orderpoints, a boolean field = False being translated
+        # into "IS NULL OR = false"
+        create_index(
+            self._cr,
+            "stock_move_location_orderpoint_consuming_index",
+            self._table,
+            ["location_id", "product_id"],
+            where="(has_move_orig IS NULL OR has_move_orig = false) "
+            "AND procure_method = 'make_to_stock' "
+            "AND state IN ('confirmed', 'partially_available')",
         )
+        create_index(
+            self._cr,
+            "stock_move_location_orderpoint_replenishment_index",
+            self._table,
+            ["location_dest_id", "product_id", "date"],
+            where="(has_move_dest IS NULL OR has_move_dest = false) "
+            "AND procure_method = 'make_to_stock' AND state = 'done'",
+        )
+
+    @api.depends("move_orig_ids", "move_dest_ids")
+    def _compute_has_move_orig_dest(self):
+        for move in self:
+            move.has_move_orig = bool(move.move_orig_ids)
+            move.has_move_dest = bool(move.move_dest_ids)
+
+    def _get_location_orderpoint_ledger_fields(self):
+        """Returns the fields whose update changes the forecast ledger"""
+        return {
+            "state",
+            "product_id",
+            "product_qty",
+            "product_uom_qty",
+            "product_uom",
+            "location_id",
+            "location_dest_id",
+        }
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        moves = super().create(vals_list)
+        ledger = self.env["stock.location.orderpoint.ledger"]
+        if ledger._get_ledger_location_ids():
+            ledger._create_deltas(ledger._add_move_deltas(ledger._new_deltas(), moves))
+        return moves
+
+    def write(self, vals):
+        ledger = self.env["stock.location.orderpoint.ledger"]
+        if not ledger._get_ledger_location_ids() or vals.keys().isdisjoint(
+            self._get_location_orderpoint_ledger_fields()
+        ):
+            return super().write(vals)
+        deltas = ledger._add_move_deltas(ledger._new_deltas(), self, sign=-1)
+        res = super().write(vals)
+        ledger._create_deltas(ledger._add_move_deltas(deltas, self))
+        return res
 
     def _prepare_auto_replenishment_for_outgoing_moves(self):
         self._prepare_auto_replenishment("location_id")
@@ -28,8 +161,28 @@ class StockMove(models.Model):
         self._prepare_auto_replenishment("location_dest_id")
 
     def _prepare_auto_replenishment(self, location_field):
+        """Buffers the moves until the end of the transaction
+
+        The moves are filtered and the jobs are enqueued once per
+        transaction in a precommit hook, whatever the number of times
+        moves are assigned or done.
+        """
         if not self or self.env.context.get("skip_auto_replenishment"):
             return
+        data = self.env.cr.precommit.data
+        if AUTO_REPLENISHMENT_BUFFER_KEY not in data:
+            data[AUTO_REPLENISHMENT_BUFFER_KEY] = defaultdict(set)
+            self.env.cr.precommit.add(self.browse()._flush_auto_replenishment)
+        data[AUTO_REPLENISHMENT_BUFFER_KEY][location_field].update(self.ids)
+
+    def _flush_auto_replenishment(self):
+        buffer = self.env.cr.precommit.data.pop(AUTO_REPLENISHMENT_BUFFER_KEY, {})
+        for location_field, move_ids in buffer.items():
+            self.browse(move_ids).exists()._enqueue_auto_replenishments(location_field)
+        # the precommit hooks are run after the flush of the transaction
+        self.env.flush_all()
+
+    def _enqueue_auto_replenishments(self, location_field):
         locations_products = defaultdict(set)
         location_ids = set()
         product_obj = self.env["product.product"]
@@ -46,16 +199,61 @@ class StockMove(models.Model):
         location_field = (
             location_field == "location_id" and location_field or "location_src_id"
         )
-        for location, products in locations_products.items():
-            # if not orderpoints._is_location_parent_of(location, location_field):
-            #    continue
-            for product in product_obj.browse(products):
+        for location, product_ids in locations_products.items():
+            products = self._merge_auto_replenishment(
+                location, product_obj.browse(product_ids), location_field
+            )
+            if products:
                 self._enqueue_auto_replenishment(
-                    location, product, location_field
+                    location, products, location_field
                 ).delay()
 
+    def _merge_auto_replenishment(self, location, products, location_field):
+        """Merges the products with the ones of a pending auto replenishment
+        job for the same location and location_field
+
+        The pending job is cancelled, so that a new job with its description
+        is enqueued for all the products.
+
+        return: the products to enqueue, empty if the pending job already
+            replenishes them
+        """
+        job_model = self.env["queue.job"].sudo()
+        prefix = _auto_replenishment_identity_prefix(location, location_field)
+        job_record = job_model.search(
+            [
+                ("identity_key", "=like", prefix + "-%"),
+                ("state", "=", "pending"),
+                ("user_id", "=", self.env.uid),
+            ],
+            limit=1,
+        )
+        if not job_record:
+            return products
+        try:
+            # Lock the job to ensure the jobrunner does not start it
+            # before it is cancelled. If the job is being started, a new
+            # job is enqueued.
+            with mute_logger("odoo.sql_db"), self.env.cr.savepoint():
+                self.env.cr.execute(
+                    "SELECT id FROM queue_job WHERE id = %s AND state = 'pending' "
+                    "FOR UPDATE NOWAIT",
+                    (job_record.id,),
+                )
+                if not self.env.cr.fetchone():
+                    return products
+        except OperationalError:
+            return products
+        job_products = job_record.args[0]
+        if products <= job_products:
+            return products.browse()
+        job = Job.load(job_model.env, job_record.uuid)
+        job.set_cancelled(result=_("Merged into a new job"))
+        job.store()
+        return job_products | products
+
     def _enqueue_auto_replenishment(
-        self, location, product, location_field, **job_options
+        self, location, products, location_field, **job_options
     ):
         """Enqueue a job stock.location.orderpoint.run_auto_replenishment()
 
@@ -69,24 +267,33 @@ class StockMove(models.Model):
             "description",
             _(
                 "Try to replenish quantities %(in_or_out)s location %(location_name)s "
-                "for product %(product_name)s"
+                "for %(product_count)s product(s)"
             )
             % {
                 "in_or_out": location_field == "location_id" and _("in") or _("from"),
                 "location_name": location.display_name,
-                "product_name": product.display_name,
+                "product_count": len(products),
             },
         )
         # do not enqueue 2 jobs for the same location and product set
-        job_options.setdefault("identity_key", identity_exact)
+        job_options.setdefault("identity_key", identity_auto_replenishment)
         delayable = self.env["stock.location.orderpoint"].delayable(**job_options)
         job = delayable.run_auto_replenishment(
-            product,
+            products,
             location,
             location_field,
         )
         return job
 
+    def _action_confirm(self, *args, **kwargs):
+        moves = super()._action_confirm(*args, **kwargs)
+        # collect the moves confirmed by a replenishment of the location
+        # orderpoints, including the ones into which they were merged
+        move_ids = self.env.context.get("location_orderpoint_move_ids")
+        if move_ids is not None:
+            move_ids.extend(moves.filtered("location_orderpoint_id").ids)
+        return moves
+
     def _action_assign(self, *args, **kwargs):
         """This triggers the replenishment for new moves which are waiting for stock"""
         res = super()._action_assign(*args, **kwargs)
@@ -0,0 +1,49 @@
+# Copyright 2026 Michael Tietz (MT Software) <mtietz@mt-software.de>
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+from odoo import api, models
+
+
+class StockQuant(models.Model):
+    _inherit = "stock.quant"
+
+    def _get_location_orderpoint_ledger_fields(self):
+        """Returns the fields whose update changes the forecast ledger"""
+        return {"quantity", "location_id", "product_id"}
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        quants = super().create(vals_list)
+        ledger = self.env["stock.location.orderpoint.ledger"]
+        if ledger._get_ledger_location_ids():
+            # In inventory mode, an existing quant can be returned. Only the
+            # quants created with a quantity change the on hand quantity.
+            new_quants = quants.browse(
+                [
+                    quant.id
+                    for quant, vals in zip(quants, vals_list)
+                    if vals.get("quantity")
+                ]
+            )
+            ledger._create_deltas(
+                ledger._add_quant_deltas(ledger._new_deltas(), new_quants)
+            )
+        return quants
+
+    def write(self, vals):
+        ledger = self.env["stock.location.orderpoint.ledger"]
+        if not ledger._get_ledger_location_ids() or vals.keys().isdisjoint(
+            self._get_location_orderpoint_ledger_fields()
+        ):
+            return super().write(vals)
+        deltas = ledger._add_quant_deltas(ledger._new_deltas(), self, sign=-1)
+        res = super().write(vals)
+        ledger._create_deltas(ledger._add_quant_deltas(deltas, self))
+        return res
+
+    def unlink(self):
+        ledger = self.env["stock.location.orderpoint.ledger"]
+        if ledger._get_ledger_location_ids():
+            ledger._create_deltas(
+                ledger._add_quant_deltas(ledger._new_deltas(), self, sign=-1)
+            )
+        return super().unlink()
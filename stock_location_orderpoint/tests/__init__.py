@@ -1,2 +1,3 @@
 from . import test_location_orderpoint
 from . import test_location_domain
+from . import test_benchmark
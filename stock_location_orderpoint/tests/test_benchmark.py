@@ -0,0 +1,226 @@
+# Copyright 2026 Michael Tietz (MT Software) <mtietz@mt-software.de>
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+"""Benchmark of the location orderpoints on synthetic warehouses
+
+The benchmark is not run with the standard tests. Run it with::
+
+    odoo -d <db> -i stock_location_orderpoint --stop-after-init \\
+        --test-tags /stock_location_orderpoint:TestLocationOrderpointBenchmark
+
+The scales are given by the environment variable
+STOCK_LOCATION_ORDERPOINT_BENCHMARK_SCALES as a comma separated list of
+locations:products:orderpoints:moves (e.g. 50:50:10:200,500:500:50:2000).
+The results are written as JSON into the file given by the environment
+variable STOCK_LOCATION_ORDERPOINT_BENCHMARK_OUTPUT, if any, with the
+version of the module and the git commit to compare the runs.
+"""
+import json
+import logging
+import os
+import subprocess
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from odoo.modules.module import get_manifest
+from odoo.tests.common import tagged
+
+from .common import TestLocationOrderpointCommon
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_SCALES = "20:20:5:50,100:100:20:500"
+
+
+@tagged("-standard", "-at_install", "post_install", "benchmark")
+class TestLocationOrderpointBenchmark(TestLocationOrderpointCommon):
+    @classmethod
+    def _get_benchmark_scales(cls):
+        scales = os.environ.get(
+            "STOCK_LOCATION_ORDERPOINT_BENCHMARK_SCALES", DEFAULT_SCALES
+        )
+        return [
+            dict(
+                zip(
+                    ("locations", "products", "orderpoints", "moves"),
+                    map(int, scale.split(":")),
+                )
+            )
+            for scale in scales.split(",")
+        ]
+
+    @classmethod
+    def _create_location_tree(cls, root, count, children_count=10):
+        """Creates count locations in a tree under root and returns the leaves"""
+        location_obj = cls.env["stock.location"]
+        parents = root
+        leaves = root
+        created = 0
+        while created < count:
+            vals_list = []
+            for parent in parents:
+                for index in range(children_count):
+                    if created + len(vals_list) >= count:
+                        break
+                    vals_list.append(
+                        {
+                            "name": f"{parent.name}-{index}",
+                            "location_id": parent.id,
+                        }
+                    )
+            locations = location_obj.create(vals_list)
+            created += len(locations)
+            leaves = (leaves - locations.location_id) | locations
+            parents = locations
+        return leaves
+
+    @classmethod
+    def _create_synthetic_warehouse(cls, locations, products, orderpoints, moves):
+        root = cls.env["stock.location"].create(
+            {
+                "name": f"Bench{locations}x{products}",
+                "location_id": cls.location_dest.id,
+            }
+        )
+        leaves = cls._create_location_tree(root, locations)
+        product_list = cls.env["product.product"].create(
+            [
+                {"name": f"Bench Product {index}", "type": "product"}
+                for index in range(products)
+            ]
+        )
+        orderpoint_list = cls.env["stock.location.orderpoint"]
+        for index, leaf in enumerate(leaves[:orderpoints]):
+            orderpoint, location_src = cls._create_orderpoint_complete(
+                f"{root.name} Reserve {index}", location_dest=leaf, trigger="cron"
+            )
+            orderpoint_list |= orderpoint
+            for product in product_list:
+                cls._create_quants(product, location_src, 1000)
+        customers = cls.env.ref("stock.stock_location_customers")
+        move_list = cls.env["stock.move"].create(
+            [
+                {
+                    "name": "Bench Delivery",
+                    "product_id": product_list[index % products].id,
+                    "product_uom": product_list[index % products].uom_id.id,
+                    "product_uom_qty": 1,
+                    "location_id": orderpoint_list[
+                        index % len(orderpoint_list)
+                    ].location_id.id,
+                    "location_dest_id": customers.id,
+                }
+                for index in range(moves)
+            ]
+        )
+        move_list._action_confirm()
+        return orderpoint_list, move_list
+
+    @contextmanager
+    def _rollback(self):
+        """Restores the database and the caches after the block"""
+        # each nested block gets its own savepoint, released after the
+        # rollback
+        savepoint = self.env.cr.savepoint()
+        try:
+            yield
+        finally:
+            savepoint.close(rollback=True)
+            self.env.invalidate_all()
+            self.registry.clear_caches()
+
+    def _measure(self, func, *args, **kwargs):
+        """Measures the peak memory of a first call rolled back, as tracing
+        the allocations slows the code down, then the time and queries of a
+        second call whose changes are kept"""
+        with self._rollback():
+            self.env.flush_all()
+            self.env.invalidate_all()
+            tracemalloc.start()
+            func(*args, **kwargs)
+            self.env.flush_all()
+            peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        self.env.flush_all()
+        self.env.invalidate_all()
+        query_count = self.env.cr.sql_log_count
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        self.env.flush_all()
+        duration = time.perf_counter() - start
+        return {
+            "time": duration,
+            "queries": self.env.cr.sql_log_count - query_count,
+            "peak_memory": peak_memory,
+        }
+
+    @classmethod
+    def _get_benchmark_version(cls):
+        """Returns the version of the module and the commit it is run on"""
+        version = {
+            "version": get_manifest("stock_location_orderpoint")["version"],
+            "commit": None,
+        }
+        try:
+            result = subprocess.run(
+                ["git", "rev-parse", "HEAD"],
+                cwd=os.path.dirname(__file__),
+                capture_output=True,
+                text=True,
+                check=False,
+            )
+        except OSError:
+            return version
+        if result.returncode == 0:
+            version["commit"] = result.stdout.strip()
+        return version
+
+    def _benchmark_scale(self, scale):
+        orderpoint_model = self.env["stock.location.orderpoint"]
+        results = {}
+        with self._rollback():
+            orderpoints, moves = self._create_synthetic_warehouse(**scale)
+            with self._rollback():
+                results["_get_orderpoints"] = self._measure(
+                    orderpoint_model._get_orderpoints, "cron", moves.location_id
+                )
+            with self._rollback():
+                results["_filter_moves_triggering_orderpoints"] = self._measure(
+                    orderpoint_model._filter_moves_triggering_orderpoints,
+                    moves,
+                    trigger="cron",
+                )
+            with self._rollback():
+                results["run_replenishment"] = self._measure(
+                    orderpoints.run_replenishment
+                )
+                results["_assign_replenishment_moves"] = self._measure(
+                    orderpoints._assign_replenishment_moves,
+                    self.env["stock.move"].search(
+                        orderpoints._prepare_to_assign_replenishment_move_domain()
+                    ),
+                )
+            with self._rollback():
+                results["run_cron_replenishment"] = self._measure(
+                    orderpoint_model.run_cron_replenishment
+                )
+        return results
+
+    def test_benchmark(self):
+        report = dict(self._get_benchmark_version(), timestamp=time.time(), scales=[])
+        for scale in self._get_benchmark_scales():
+            results = self._benchmark_scale(scale)
+            report["scales"].append(dict(scale, results=results))
+            for operation, values in results.items():
+                _logger.info(
+                    "benchmark %s %s: %.3fs, %s queries, %s bytes",
+                    scale,
+                    operation,
+                    values["time"],
+                    values["queries"],
+                    values["peak_memory"],
+                )
+        output = os.environ.get("STOCK_LOCATION_ORDERPOINT_BENCHMARK_OUTPUT")
+        if output:
+            with open(output, "w") as output_file:
+                json.dump(report, output_file, indent=2)
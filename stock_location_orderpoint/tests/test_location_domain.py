@@ -46,3 +46,29 @@ class TestLocationOrderpoint(TestLocationOrderpointCommon):
         self._run_replenishment(orderpoints)
         replenish_move = self._get_replenishment_move(orderpoints)
         self._assert_replenishment_move(replenish_move, 12, orderpoint)
+
+    def test_excluded_location_domain_key(self):
+        """Orderpoints with equivalent excluded location domains are grouped
+        together to compute the quantities only once"""
+        orderpoint, _location_src = self._create_orderpoint_complete(
+            "Stock2", trigger="manual"
+        )
+        orderpoint2, _location_src2 = self._create_orderpoint_complete(
+            "Stock2.2", trigger="manual"
+        )
+        orderpoints = orderpoint | orderpoint2
+        self.assertEqual(
+            orderpoint._get_excluded_location_domain_key(),
+            orderpoint2._get_excluded_location_domain_key(),
+        )
+        orderpoint.stock_excluded_location_domain = [
+            ("location_id.usage", "!=", "supplier")
+        ]
+        orderpoint2.stock_excluded_location_domain = [
+            ["location_id.usage", "!=", "supplier"]
+        ]
+        self.assertEqual(len(list(orderpoints._group_by_excluded_location_domain())), 1)
+        orderpoint2.stock_excluded_location_domain = [
+            ("location_id.usage", "!=", "customer")
+        ]
+        self.assertEqual(len(list(orderpoints._group_by_excluded_location_domain())), 2)
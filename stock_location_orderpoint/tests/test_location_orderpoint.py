@@ -1,18 +1,22 @@
 # Copyright 2023 Michael Tietz (MT Software) <mtietz@mt-software.de>
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
-from contextlib import contextmanager
+from collections import defaultdict
+from contextlib import closing, contextmanager
+from datetime import timedelta
 from unittest.mock import patch
 
 import freezegun
 from psycopg2 import IntegrityError
 
-from odoo import fields
+from odoo import SUPERUSER_ID, api, fields, sql_db
 from odoo.exceptions import ValidationError
 from odoo.tools import mute_logger
 
-from odoo.addons.queue_job.job import identity_exact
+from odoo.addons.queue_job.exception import RetryableJobError
 from odoo.addons.queue_job.tests.common import trap_jobs
 
+from ..models.stock_location_orderpoint import _zero_quantities
+from ..models.stock_move import identity_auto_replenishment
 from .common import TestLocationOrderpointCommon
 
 
@@ -59,6 +63,230 @@ class TestLocationOrderpoint(TestLocationOrderpointCommon):
         move = replenish_moves - move
         self._assert_replenishment_move(move, 1, orderpoint2)
 
+    def test_manual_replenishment_chunked(self):
+        self.env["ir.config_parameter"].sudo().set_param(
+            "stock_location_orderpoint.replenishment_chunk_size", 1
+        )
+        orderpoint, location_src = self._create_orderpoint_complete(
+            "Stock2", trigger="manual"
+        )
+        product2 = self.product.copy()
+        self._create_outgoing_move(12)
+        self._create_outgoing_move(5, product=product2)
+        self._create_quants(self.product, location_src, 12)
+        self._create_quants(product2, location_src, 12)
+        self.assertEqual(
+            orderpoint._find_potential_product_ids_to_replenish(),
+            sorted((self.product | product2).ids),
+        )
+        self.assertEqual(len(list(orderpoint._iter_procurements(chunk_size=1))), 2)
+        self._run_replenishment(orderpoint)
+        replenish_move = self._get_replenishment_move(orderpoint)
+        self._assert_replenishment_move(replenish_move, 12, orderpoint)
+        replenish_move = self._get_replenishment_move(orderpoint, product=product2)
+        self._assert_replenishment_move(replenish_move, 5, orderpoint)
+
+    def test_manual_replenishment_bulk(self):
+        self.env["ir.config_parameter"].sudo().set_param(
+            "stock_location_orderpoint.bulk_procurements", True
+        )
+        orderpoint, location_src = self._create_orderpoint_complete(
+            "Stock2", trigger="manual"
+        )
+        product2 = self.product.copy()
+        self._create_outgoing_move(12)
+        self._create_outgoing_move(5, product=product2)
+        self._create_quants(self.product, location_src, 12)
+        self._create_quants(product2, location_src, 12)
+        group_model = type(self.env["procurement.group"])
+        with patch.object(
+            group_model, "_get_rule", autospec=True, side_effect=group_model._get_rule
+        ) as get_rule, patch.object(group_model, "run", autospec=True) as run:
+            self._run_replenishment(orderpoint)
+        self.assertEqual(get_rule.call_count, 1)
+        run.assert_not_called()
+        replenish_move = self._get_replenishment_move(orderpoint)
+        self._assert_replenishment_move(replenish_move, 12, orderpoint)
+        replenish_move2 = self._get_replenishment_move(orderpoint, product=product2)
+        self._assert_replenishment_move(replenish_move2, 5, orderpoint)
+        self.assertEqual(replenish_move.picking_id, replenish_move2.picking_id)
+
+    def test_picking_sharding(self):
+        orderpoint, location_src = self._create_orderpoint_complete(
+            "Stock2", trigger="manual"
+        )
+        self.assertFalse(orderpoint._get_picking_shard_group())
+        orderpoint.picking_sharding = "time"
+        self._create_quants(self.product, location_src, 24)
+        now = fields.Datetime.now()
+        for date in (now, now + timedelta(hours=1)):
+            self._create_outgoing_move(12)
+            self.product.invalidate_recordset()
+            with self._freeze_time(date):
+                self._run_replenishment(orderpoint)
+        moves = self._get_replenishment_move(orderpoint)
+        self.assertEqual(len(moves), 2)
+        self.assertEqual(len(moves.group_id), 2)
+        self.assertEqual(len(moves.picking_id), 2)
+        self.assertEqual(moves.group_id.location_orderpoint_id, orderpoint)
+
+        orderpoint.picking_sharding = "transaction"
+        job_orderpoint = orderpoint.with_context(job_uuid="job1")
+        group = job_orderpoint._get_picking_shard_group()
+        self.assertNotIn(group, moves.group_id)
+        self.assertEqual(job_orderpoint._get_picking_shard_group(), group)
+        # the jobs share a bounded number of groups
+        self.env["ir.config_parameter"].sudo().set_param(
+            "stock_location_orderpoint.picking_shard_count", 2
+        )
+        groups = self.env["procurement.group"]
+        for job_uuid in ("job1", "job2", "job3", "job4"):
+            groups |= orderpoint.with_context(
+                job_uuid=job_uuid
+            )._get_picking_shard_group()
+        self.assertLessEqual(len(groups), 2)
+
+        # the groups left without moves are garbage collected
+        empty_groups = groups | group
+        self.env.cr.execute(
+            "UPDATE procurement_group SET create_date = %s WHERE id IN %s",
+            (now - timedelta(days=2), tuple(empty_groups.ids)),
+        )
+        self.env["procurement.group"]._gc_location_orderpoint_shards()
+        self.assertFalse(empty_groups.exists())
+        self.assertEqual(len(moves.group_id.exists()), 2)
+
+    def test_replenishment_lock(self):
+        orderpoint, location_src = self._create_orderpoint_complete(
+            "Stock2", trigger="auto"
+        )
+        locks = orderpoint._get_replenishment_lock_keys(self.product)
+        self.assertEqual(len(locks), 4)
+        self.assertEqual(sorted(shared for _key, shared in locks), [0, 0, 1, 1])
+        self.assertEqual(locks, sorted(locks))
+        locks = orderpoint._get_replenishment_lock_keys()
+        self.assertEqual([shared for _key, shared in locks], [False, False])
+
+        stats = orderpoint._get_replenishment_lock_stats()
+        location_key, _shared = orderpoint._get_replenishment_lock_keys()[0]
+        with closing(sql_db.db_connect(self.env.cr.dbname).cursor()) as cr:
+            cr.execute("SELECT pg_advisory_xact_lock(%s)", (location_key,))
+            with self.assertRaises(RetryableJobError):
+                orderpoint.with_context(job_uuid="test").run_replenishment(self.product)
+            cr.rollback()
+        new_stats = orderpoint._get_replenishment_lock_stats()
+        self.assertEqual(new_stats["conflicts"], stats.get("conflicts", 0) + 1)
+        self.assertEqual(new_stats["retries"], stats.get("retries", 0) + 1)
+        # the locks are held until the end of the transaction and taken again
+        # by the next replenishments of the same transaction
+        orderpoint.with_context(job_uuid="test").run_replenishment(self.product)
+        orderpoint.with_context(job_uuid="test").run_replenishment()
+        self.assertEqual(orderpoint._get_replenishment_lock_stats(), new_stats)
+
+    def test_manual_replenishment_in_flight(self):
+        """The quantities replenished by concurrent transactions are not
+        replenished again"""
+        in_flight_model = self.env["stock.location.orderpoint.in.flight"]
+        orderpoint, location_src = self._create_orderpoint_complete(
+            "Stock2", trigger="manual"
+        )
+        self._create_outgoing_move(12)
+        self._create_quants(self.product, location_src, 12)
+
+        # the test transaction is never committed, read the quantities
+        # with its own snapshot
+        @contextmanager
+        def _get_snapshot_cursor(model):
+            yield model.env.cr
+
+        with closing(
+            sql_db.db_connect(self.env.cr.dbname).cursor()
+        ) as cr, patch.object(
+            type(in_flight_model), "_get_snapshot_cursor", _get_snapshot_cursor
+        ):
+            cr.execute("SELECT txid_current()")
+            concurrent_transaction_id = str(cr.fetchone()[0])
+            in_flight_model.create(
+                {
+                    "orderpoint_id": orderpoint.id,
+                    "product_id": self.product.id,
+                    "quantity": 5,
+                    "transaction_id": concurrent_transaction_id,
+                    "date": fields.Datetime.now(),
+                }
+            )
+            self.assertEqual(
+                in_flight_model._get_quantities(orderpoint, self.product),
+                {(orderpoint.id, self.product.id): 5},
+            )
+            self._run_replenishment(orderpoint)
+            replenish_move = self._get_replenishment_move(orderpoint)
+            self._assert_replenishment_move(replenish_move, 7, orderpoint)
+            cr.rollback()
+            # the quantities of aborted transactions are ignored
+            self.assertFalse(in_flight_model._get_quantities(orderpoint, self.product))
+        # the quantities of the current transaction are registered
+        records = in_flight_model.search([("orderpoint_id", "=", orderpoint.id)])
+        self.assertEqual(sorted(records.mapped("quantity")), [5, 7])
+
+    def test_replenishment_phases(self):
+        orderpoint, location_src = self._create_orderpoint_complete(
+            "Stock2", trigger="manual"
+        )
+        self._create_outgoing_move(12)
+        self._create_quants(self.product, location_src, 12)
+        phases = []
+        with patch.object(
+            type(orderpoint),
+            "_notify_replenishment_phase",
+            autospec=True,
+            side_effect=lambda orderpoints, values: phases.append(values),
+        ):
+            self._run_replenishment(orderpoint)
+        self.assertEqual(
+            [values["phase"] for values in phases],
+            [
+                "find_moves",
+                "compute_quantities",
+                "prepare_procurements",
+                "run_procurements",
+                "assign_moves",
+            ],
+        )
+        for values in phases:
+            self.assertEqual(values["orderpoint_ids"], orderpoint.ids)
+            self.assertEqual(values["count"], 1)
+            self.assertGreaterEqual(values["time"], 0)
+            self.assertGreater(values["queries"], 0)
+
+    def test_sweep_replenishment_moves(self):
+        orderpoint, location_src = self._create_orderpoint_complete(
+            "Stock2", trigger="manual"
+        )
+        product2 = self.product.copy()
+        self._create_outgoing_move(12)
+        self._create_outgoing_move(12, product=product2)
+        self._create_quants(self.product, location_src, 12)
+        self._create_quants(product2, location_src, 12)
+        self._run_replenishment(orderpoint)
+        replenish_moves = self._get_replenishment_move(
+            orderpoint
+        ) | self._get_replenishment_move(orderpoint, product=product2)
+        self.assertEqual(len(replenish_moves), 2)
+        self.assertEqual(set(replenish_moves.mapped("state")), {"assigned"})
+        replenish_moves._do_unreserve()
+        self.assertEqual(set(replenish_moves.mapped("state")), {"confirmed"})
+        # all the moves are swept, by pages of one move
+        self.env["stock.location.orderpoint"]._sweep_replenishment_moves(limit=1)
+        self.assertEqual(set(replenish_moves.mapped("state")), {"assigned"})
+        # the moves of the other replenishments are not assigned by the
+        # next ones
+        replenish_moves._do_unreserve()
+        orderpoint._assign_replenishment_moves(replenish_moves.browse())
+        self.assertEqual(set(replenish_moves.mapped("state")), {"confirmed"})
+        orderpoint._assign_replenishment_moves()
+        self.assertEqual(set(replenish_moves.mapped("state")), {"assigned"})
+
     @contextmanager
     def _freeze_time(self, now):
         with freezegun.freeze_time(now), patch.object(
@@ -109,11 +337,190 @@ class TestLocationOrderpoint(TestLocationOrderpointCommon):
         self._assert_replenishment_move(replenish_move, 12, orderpoint)
         self.assertEqual(orderpoint.last_cron_execution, day_after_tomorrow)
 
+    def test_cron_replenishment_watermark(self):
+        """The cron progress does not update the orderpoints nor their
+        cached domains"""
+        cron = self.env.ref("stock_location_orderpoint.ir_cron_location_replenishment")
+        orderpoint, _location_src = self._create_orderpoint_complete(
+            "Stock2", trigger="cron"
+        )
+        self._create_outgoing_move(12)
+        self.env.flush_all()
+        write_date = orderpoint.write_date
+        with self._freeze_time(fields.Datetime.now()):
+            cron.method_direct_trigger()
+        stats = orderpoint._get_moves_domain_cache_stats()
+        tomorrow = fields.Datetime.now() + timedelta(days=1)
+        with self._freeze_time(tomorrow):
+            cron.method_direct_trigger()
+        new_stats = orderpoint._get_moves_domain_cache_stats()
+        self.assertEqual(new_stats["miss"], stats["miss"])
+        self.assertGreater(new_stats["hit"], stats["hit"])
+        self.assertEqual(orderpoint.write_date, write_date)
+        self.assertEqual(orderpoint.last_cron_execution, tomorrow)
+        watermark = self.env["stock.location.orderpoint.watermark"].search(
+            [("orderpoint_id", "=", orderpoint.id)]
+        )
+        self.assertEqual(watermark.last_cron_execution, tomorrow)
+
+    def test_cron_replenishment_write_date(self):
+        """The moves are selected by last update, whatever their date"""
+        cron = self.env.ref("stock_location_orderpoint.ir_cron_location_replenishment")
+        orderpoint, location_src = self._create_orderpoint_complete(
+            "Stock2", trigger="cron"
+        )
+        orderpoint.cron_move_selection = "write_date"
+        now = fields.Datetime.now()
+        with self._freeze_time(now):
+            cron.method_direct_trigger()
+        # the start of the oldest running transaction, at most the test one
+        self.assertLessEqual(orderpoint.last_cron_execution, now)
+        self.assertEqual(orderpoint._get_cron_write_date_margin(), 300 + 600)
+
+        # a move planned in the past but confirmed after the last execution
+        tomorrow = now + timedelta(days=1)
+        with self._freeze_time(tomorrow):
+            self._create_quants(self.product, location_src, 12)
+            move = self._create_outgoing_move(12)
+            move.date = now - timedelta(days=30)
+        self.product.invalidate_recordset()
+        with self._freeze_time(tomorrow + timedelta(days=1)):
+            cron.method_direct_trigger()
+        replenish_move = self._get_replenishment_move(orderpoint)
+        self._assert_replenishment_move(replenish_move, 12, orderpoint)
+
+    def test_cron_replenishment_backfill(self):
+        """The first execution processes the moves by windows"""
+        self.env["ir.config_parameter"].sudo().set_param(
+            "stock_location_orderpoint.cron_backfill_window_hours", 48
+        )
+        orderpoint, location_src = self._create_orderpoint_complete(
+            "Stock2", trigger="cron"
+        )
+        self._create_quants(self.product, location_src, 12)
+        move = self._create_outgoing_move(12)
+        now = fields.Datetime.now()
+        move.date = now - timedelta(days=3)
+        self.product.invalidate_recordset()
+        windows = []
+        run_replenishment = type(orderpoint).run_replenishment
+
+        def _run_replenishment(orderpoints, products=False):
+            windows.append(
+                (
+                    orderpoints.last_cron_execution,
+                    orderpoints.env.context.get("location_orderpoint_cron_date_to"),
+                )
+            )
+            return run_replenishment(orderpoints, products=products)
+
+        with self._freeze_time(now), patch.object(
+            type(orderpoint), "run_replenishment", _run_replenishment
+        ):
+            orderpoint._run_cron_replenishment()
+        self.assertEqual(
+            windows,
+            [
+                (now - timedelta(days=7), now - timedelta(days=5)),
+                (now - timedelta(days=5), now - timedelta(days=3)),
+                (now - timedelta(days=3), now - timedelta(days=1)),
+                (now - timedelta(days=1), None),
+            ],
+        )
+        replenish_move = self._get_replenishment_move(orderpoint)
+        self._assert_replenishment_move(replenish_move, 12, orderpoint)
+        self.assertEqual(orderpoint.last_cron_execution, now)
+
+    def test_cron_replenishment_sharded(self):
+        self.env["ir.config_parameter"].sudo().set_param(
+            "stock_location_orderpoint.cron_shard_by", "warehouse"
+        )
+        job_func = self.env["stock.location.orderpoint"].run_cron_replenishment_shard
+        orderpoint, location_src = self._create_orderpoint_complete(
+            "Stock2", trigger="cron"
+        )
+        self._create_outgoing_move(12)
+        self._set_qty_in_location(self.product, location_src, 12)
+        self.product.invalidate_recordset()
+        with trap_jobs() as trap:
+            self.env["stock.location.orderpoint"].run_cron_replenishment()
+            trap.assert_jobs_count(1, only=job_func)
+            trap.assert_enqueued_job(orderpoint.run_cron_replenishment_shard)
+            # the orderpoints are replenished by the job only
+            self.assertFalse(orderpoint.last_cron_execution)
+            self.assertFalse(self._get_replenishment_move(orderpoint))
+            now = fields.Datetime.now()
+            with self._freeze_time(now):
+                trap.perform_enqueued_jobs()
+        replenish_move = self._get_replenishment_move(orderpoint)
+        self._assert_replenishment_move(replenish_move, 12, orderpoint)
+        self.assertEqual(orderpoint.last_cron_execution, now)
+
+    def test_replenishment_run(self):
+        run_model = self.env["stock.location.orderpoint.run"]
+        orderpoint, location_src = self._create_orderpoint_complete(
+            "Stock2", trigger="cron"
+        )
+        # not the first execution, which is run by windows of moves
+        orderpoint._set_last_cron_execution(fields.Datetime.now() - timedelta(days=1))
+        self._create_outgoing_move(12)
+        self._create_quants(self.product, location_src, 12)
+        self.product.invalidate_recordset()
+        runs = run_model.search([])
+        self.env["stock.location.orderpoint"].run_cron_replenishment()
+        run = run_model.search([]) - runs
+        self.assertEqual(len(run), 1)
+        self.assertEqual(run.trigger, "cron")
+        self.assertEqual(run.state, "done")
+        self.assertEqual(run.orderpoint_ids, orderpoint)
+        self.assertEqual(run.product_count, 1)
+        self.assertEqual(run.procurement_count, 1)
+        self.assertEqual(
+            run.phase_ids.mapped("name"),
+            [
+                "find_moves",
+                "compute_quantities",
+                "prepare_procurements",
+                "run_procurements",
+                "assign_moves",
+            ],
+        )
+        self.assertEqual(run.query_count, sum(run.phase_ids.mapped("query_count")))
+
+        run.date_start = fields.Datetime.now() - timedelta(days=31)
+        run_model._gc_runs()
+        self.assertFalse(run.exists())
+
+        # the failed run is committed in its own transaction, and kept when
+        # the transaction of the replenishment is rolled back
+        date_start = fields.Datetime.now()
+        with patch.object(
+            type(orderpoint), "run_replenishment", side_effect=ValueError("Failure")
+        ), self.assertRaises(ValueError), self.env.cr.savepoint():
+            self.env["stock.location.orderpoint"].run_cron_replenishment()
+        with patch.object(
+            type(orderpoint),
+            "run_replenishment",
+            side_effect=RetryableJobError("Locked"),
+        ), self.assertRaises(RetryableJobError), self.env.cr.savepoint():
+            self.env["stock.location.orderpoint"].run_cron_replenishment()
+        with self.registry.cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            run = env["stock.location.orderpoint.run"].search(
+                [("date_start", ">=", date_start), ("trigger", "=", "cron")]
+            )
+            self.assertEqual(run.mapped("state"), ["failed"])
+            self.assertEqual(run.error, "Failure")
+            # the orderpoint of the uncommitted test transaction is not visible
+            self.assertFalse(run.orderpoint_ids)
+            run.unlink()
+
     def test_auto_replenishment(self):
         job_func = self.env["stock.location.orderpoint"].run_auto_replenishment
         move_qty = 12
         with trap_jobs() as trap:
             move = self._create_outgoing_move(move_qty)
+            self.env.cr.flush()
             trap.assert_jobs_count(0, only=job_func)
             trap.perform_enqueued_jobs()
             replenish_move = self.env["stock.move"].search(
@@ -129,13 +536,14 @@ class TestLocationOrderpoint(TestLocationOrderpointCommon):
         )
         with trap_jobs() as trap:
             move = self._create_outgoing_move(move_qty)
+            self.env.cr.flush()
             trap.assert_jobs_count(1, only=job_func)
             trap.assert_enqueued_job(
                 orderpoint.browse([]).run_auto_replenishment,
                 args=(move.product_id, move.location_id, "location_id"),
                 kwargs={},
                 properties=dict(
-                    identity_key=identity_exact,
+                    identity_key=identity_auto_replenishment,
                 ),
             )
             self.product.invalidate_recordset()
@@ -145,13 +553,14 @@ class TestLocationOrderpoint(TestLocationOrderpointCommon):
 
         with trap_jobs() as trap:
             move = self._create_incoming_move(move_qty, location_src)
+            self.env.cr.flush()
             trap.assert_jobs_count(1, only=job_func)
             trap.assert_enqueued_job(
                 orderpoint.browse([]).run_auto_replenishment,
                 args=(move.product_id, move.location_dest_id, "location_src_id"),
                 kwargs={},
                 properties=dict(
-                    identity_key=identity_exact,
+                    identity_key=identity_auto_replenishment,
                 ),
             )
             self.product.invalidate_recordset()
@@ -161,15 +570,17 @@ class TestLocationOrderpoint(TestLocationOrderpointCommon):
 
         # Create a second incoming move so that the qty_available would be 24
         move = self._create_incoming_move(move_qty, location_src)
+        self.env.cr.flush()
         with trap_jobs() as trap:
             move = self._create_outgoing_move(move_qty)
+            self.env.cr.flush()
             trap.assert_jobs_count(1, only=job_func)
             trap.assert_enqueued_job(
                 orderpoint.browse([]).run_auto_replenishment,
                 args=(move.product_id, move.location_id, "location_id"),
                 kwargs={},
                 properties=dict(
-                    identity_key=identity_exact,
+                    identity_key=identity_auto_replenishment,
                 ),
             )
             self.product.invalidate_recordset()
@@ -192,13 +603,14 @@ class TestLocationOrderpoint(TestLocationOrderpointCommon):
         )
         with trap_jobs() as trap:
             move = self._create_outgoing_move(move_qty)
+            self.env.cr.flush()
             trap.assert_jobs_count(1, only=job_func)
             trap.assert_enqueued_job(
                 orderpoint.browse([]).run_auto_replenishment,
                 args=(move.product_id, move.location_id, "location_id"),
                 kwargs={},
                 properties=dict(
-                    identity_key=identity_exact,
+                    identity_key=identity_auto_replenishment,
                 ),
             )
             self.product.invalidate_recordset()
@@ -208,13 +620,14 @@ class TestLocationOrderpoint(TestLocationOrderpointCommon):
 
         with trap_jobs() as trap:
             move = self._create_incoming_move(move_qty, location_src)
+            self.env.cr.flush()
             trap.assert_jobs_count(1, only=job_func)
             trap.assert_enqueued_job(
                 orderpoint.browse([]).run_auto_replenishment,
                 args=(move.product_id, move.location_dest_id, "location_src_id"),
                 kwargs={},
                 properties=dict(
-                    identity_key=identity_exact,
+                    identity_key=identity_auto_replenishment,
                 ),
             )
             job = trap.enqueued_jobs[0]
@@ -222,6 +635,93 @@ class TestLocationOrderpoint(TestLocationOrderpointCommon):
                 job.channel, "root.stock_location_orderpoint_auto_replenishment"
             )
 
+    def test_auto_replenishment_coalesce(self):
+        """
+        Check that the products moved out of a location are replenished
+        by one job, and that products are merged into the pending job
+        """
+        job_func = self.env["stock.location.orderpoint"].run_auto_replenishment
+        move_qty = 12
+        orderpoint, _location_src = self._create_orderpoint_complete(
+            "Stock2", trigger="auto"
+        )
+        product2 = self.product.copy()
+        with trap_jobs() as trap:
+            move = self._create_move(
+                "Delivery",
+                move_qty,
+                self.location_dest,
+                self.env.ref("stock.stock_location_customers"),
+            )
+            move2 = self._create_move(
+                "Delivery",
+                move_qty,
+                self.location_dest,
+                self.env.ref("stock.stock_location_customers"),
+                product=product2,
+            )
+            (move | move2)._action_assign()
+            self.env.cr.flush()
+            trap.assert_jobs_count(1, only=job_func)
+            trap.assert_enqueued_job(
+                orderpoint.browse([]).run_auto_replenishment,
+                args=(self.product | product2, self.location_dest, "location_id"),
+                kwargs={},
+                properties=dict(
+                    identity_key=identity_auto_replenishment,
+                ),
+            )
+
+        job_domain = [
+            ("model_name", "=", "stock.location.orderpoint"),
+            ("method_name", "=", "run_auto_replenishment"),
+        ]
+        existing_jobs = self.env["queue.job"].search(job_domain)
+        self._create_outgoing_move(move_qty)
+        self.env.cr.flush()
+        job = self.env["queue.job"].search(job_domain) - existing_jobs
+        self.assertEqual(len(job), 1)
+        self.assertEqual(job.args[0], self.product)
+        self._create_outgoing_move(move_qty, product=product2)
+        self.env.cr.flush()
+        self.assertEqual(job.state, "cancelled")
+        new_job = self.env["queue.job"].search(job_domain) - existing_jobs - job
+        self.assertEqual(len(new_job), 1)
+        self.assertEqual(new_job.state, "pending")
+        self.assertEqual(new_job.args[0], self.product | product2)
+        self.assertEqual(tuple(new_job.args[1:]), (self.location_dest, "location_id"))
+        self.assertIn("2 product(s)", new_job.name)
+        # the products already replenished by the pending job are not enqueued
+        self._create_outgoing_move(move_qty)
+        self.env.cr.flush()
+        self.assertFalse(
+            self.env["queue.job"].search(job_domain) - existing_jobs - job - new_job
+        )
+
+    def test_auto_replenishment_buffer(self):
+        """
+        Check that the moves assigned in several calls in the same
+        transaction are replenished by one job enqueued at commit time
+        """
+        job_func = self.env["stock.location.orderpoint"].run_auto_replenishment
+        orderpoint, _location_src = self._create_orderpoint_complete(
+            "Stock2", trigger="auto"
+        )
+        product2 = self.product.copy()
+        with trap_jobs() as trap:
+            self._create_outgoing_move(12)
+            self._create_outgoing_move(12, product=product2)
+            trap.assert_jobs_count(0, only=job_func)
+            self.env.cr.flush()
+            trap.assert_jobs_count(1, only=job_func)
+            trap.assert_enqueued_job(
+                orderpoint.browse([]).run_auto_replenishment,
+                args=(self.product | product2, self.location_dest, "location_id"),
+                kwargs={},
+            )
+            self.env.cr.flush()
+            trap.assert_jobs_count(1, only=job_func)
+
     def test_auto_no_replenishment(self):
         """
         Create a stock move that should not create a replenishment:
@@ -239,6 +739,7 @@ class TestLocationOrderpoint(TestLocationOrderpointCommon):
             self.location_dest = new_location
             self._create_quants(self.product, self.location_dest, 10.0)
             move = self._create_scrap_move(10.0, self.location_dest)
+            self.env.cr.flush()
             trap.assert_jobs_count(0, only=job_func)
             trap.perform_enqueued_jobs()
             replenish_move = self.env["stock.move"].search(
@@ -258,3 +759,290 @@ class TestLocationOrderpoint(TestLocationOrderpointCommon):
         self.assertEqual(1, self.location_dest.location_orderpoint_count)
         _, _ = self._create_orderpoint_complete("Stock3", trigger="cron")
         self.assertEqual(2, self.location_dest.location_orderpoint_count)
+
+    def test_get_orderpoints(self):
+        orderpoint_model = self.env["stock.location.orderpoint"]
+        orderpoint, location_src = self._create_orderpoint_complete(
+            "Stock2", trigger="auto"
+        )
+        sub_location = self.env["stock.location"].create(
+            {"name": "Sub Stock", "location_id": self.location_dest.id}
+        )
+        # fill the index before moving the location
+        self.assertEqual(
+            orderpoint_model._get_orderpoints("auto", sub_location), orderpoint
+        )
+        self.assertEqual(
+            orderpoint_model._get_orderpoints("auto", self.location_dest), orderpoint
+        )
+        self.assertFalse(
+            orderpoint_model._get_orderpoints("auto", self.location_dest.location_id)
+        )
+        self.assertEqual(
+            orderpoint_model._get_orderpoints(
+                "auto", location_src, location_field="location_src_id"
+            ),
+            orderpoint,
+        )
+        self.assertFalse(
+            orderpoint_model._get_orderpoints(
+                "auto", sub_location, location_field="location_src_id"
+            )
+        )
+        # the index is reset when a location is moved
+        sub_location.location_id = location_src
+        self.assertFalse(orderpoint_model._get_orderpoints("auto", sub_location))
+        self.assertEqual(
+            orderpoint_model._get_orderpoints(
+                "auto", sub_location, location_field="location_src_id"
+            ),
+            orderpoint,
+        )
+        # the index is reset when the trigger of an orderpoint changes
+        orderpoint.trigger = "cron"
+        self.assertFalse(
+            orderpoint_model._get_orderpoints(
+                "auto", sub_location, location_field="location_src_id"
+            )
+        )
+        self.assertEqual(
+            orderpoint_model._get_orderpoints(
+                "cron", sub_location, location_field="location_src_id"
+            ),
+            orderpoint,
+        )
+
+    def test_filter_moves_triggering_orderpoints(self):
+        """The compiled predicate selects the same moves as the domain"""
+        orderpoint_model = self.env["stock.location.orderpoint"]
+        orderpoint, location_src = self._create_orderpoint_complete(
+            "Stock2", trigger="cron"
+        )
+        orderpoint2, _location_src2 = self._create_orderpoint_complete(
+            "Stock3", trigger="auto"
+        )
+        self._create_outgoing_move(12)
+        self._create_incoming_move(12, location_src)
+        self._create_scrap_move(1, location_src)
+        self._create_move(
+            "Receipt",
+            5.0,
+            self.env.ref("stock.stock_location_suppliers"),
+            self.location_dest,
+        )
+        moves = self.env["stock.move"].search([])
+        for orderpoints in (orderpoint, orderpoint2, orderpoint | orderpoint2):
+            domain = orderpoint_model._get_moves_domain(orderpoints.ids)
+            predicate = orderpoint_model._compile_domain_predicate(
+                self.env["stock.move"], domain
+            )
+            self.assertTrue(moves.filtered_domain(domain))
+            self.assertEqual(moves.filtered(predicate), moves.filtered_domain(domain))
+        domain = [
+            "|",
+            ("date", "<", "2000-01-01 00:00:00"),
+            "!",
+            ("state", "not in", ["done", "cancel"]),
+        ]
+        predicate = orderpoint_model._compile_domain_predicate(
+            self.env["stock.move"], domain
+        )
+        self.assertEqual(moves.filtered(predicate), moves.filtered_domain(domain))
+
+    def test_move_has_move_orig_dest(self):
+        move = self._create_outgoing_move(1)
+        move2 = self._create_outgoing_move(1)
+        self.assertFalse(move.has_move_dest)
+        self.assertFalse(move2.has_move_orig)
+        move.move_dest_ids = move2
+        self.assertTrue(move.has_move_dest)
+        self.assertTrue(move2.has_move_orig)
+        self.assertFalse(move.has_move_orig)
+        move2.move_orig_ids = False
+        self.assertFalse(move.has_move_dest)
+        self.assertFalse(move2.has_move_orig)
+
+    def test_moves_domain_cache(self):
+        """The orderpoints sharing the same configuration share the cached
+        domain fragments"""
+        orderpoint, _location_src = self._create_orderpoint_complete(
+            "Stock2", trigger="auto"
+        )
+        orderpoint2, _location_src2 = self._create_orderpoint_complete(
+            "Stock3", trigger="auto"
+        )
+        orderpoint_model = self.env["stock.location.orderpoint"]
+        orderpoint_model._get_moves_domain_fragment.clear_cache(orderpoint_model)
+        stats = orderpoint_model._get_moves_domain_cache_stats()
+        orderpoint._get_consuming_moves_domain()
+        orderpoint2._get_consuming_moves_domain()
+        new_stats = orderpoint_model._get_moves_domain_cache_stats()
+        self.assertEqual(new_stats["miss"], stats["miss"] + 1)
+        self.assertEqual(new_stats["hit"], stats["hit"] + 1)
+        domain = (orderpoint | orderpoint2)._get_consuming_moves_domain()
+        self.assertIn(
+            ("location_id", "child_of", (orderpoint | orderpoint2).location_id.ids),
+            domain,
+        )
+
+    def test_moves_domain_merged_by_shape(self):
+        """The groups of orderpoints differing only by their cron progress
+        are merged into one domain"""
+        orderpoint, _location_src = self._create_orderpoint_complete(
+            "Stock2", trigger="cron"
+        )
+        orderpoint2, _location_src2 = self._create_orderpoint_complete(
+            "Stock3", trigger="cron"
+        )
+        now = fields.Datetime.now()
+        orderpoint._set_last_cron_execution(now - timedelta(days=2))
+        orderpoint2._set_last_cron_execution(now - timedelta(days=1))
+        orderpoints = orderpoint | orderpoint2
+        self.assertEqual(len(list(orderpoints._group_by_domain_config())), 2)
+        domain = orderpoints._get_consuming_moves_domain()
+        self.assertNotIn("|", domain)
+        self.assertIn(
+            ("location_id", "child_of", sorted(orderpoints.location_id.ids)), domain
+        )
+        self.assertIn(("date", ">=", now - timedelta(days=2)), domain)
+        # the groups with different shapes are not merged
+        orderpoint2.cron_move_selection = "write_date"
+        self.assertIn("|", orderpoints._get_consuming_moves_domain())
+
+    def test_get_replenishment_dates(self):
+        orderpoint, _location_src = self._create_orderpoint_complete(
+            "Stock2", trigger="manual"
+        )
+        move = self._create_outgoing_move(1)
+        move2 = self._create_outgoing_move(1)
+        move2.date = move.date - timedelta(days=1)
+        dates = orderpoint._find_potential_products_to_replenish_by_location()
+        self.assertEqual(dates[(self.location_dest.id, self.product.id)], move2.date)
+        products_by_location = orderpoint._get_products_by_location(dates)
+        self.assertIn(self.product, products_by_location[self.location_dest])
+        self.assertFalse(
+            orderpoint._find_potential_products_to_replenish_by_location(
+                self.env["product.product"].create({"name": "Other"})
+            )
+        )
+
+    def test_qties_to_replenish_batch(self):
+        """The batched fill up computes the same quantities as the scalar one"""
+        orderpoint, location_src = self._create_orderpoint_complete(
+            "Stock2", trigger="manual"
+        )
+        products = self.env["product.product"].create(
+            [{"name": f"Batch {index}", "type": "product"} for index in range(5)]
+        )
+        # (virtual available on dest, virtual available and incoming on src,
+        # already replenished)
+        quantities = [(5, 10, 0, 0), (-5, 0, 0, 0), (-5, 10, 8, 0), (-5, 3, 0, 0)]
+        quantities.append((-5, 10, 0, 2))
+        qties_on_locations = {
+            orderpoint.location_id: defaultdict(_zero_quantities),
+            location_src: defaultdict(_zero_quantities),
+        }
+        for product, (dest, src, incoming, _replenished) in zip(products, quantities):
+            qties_on_locations[orderpoint.location_id][product][
+                "virtual_available"
+            ] = dest
+            qties_on_locations[location_src][product].update(
+                virtual_available=src, incoming_qty=incoming
+            )
+        results = []
+        for batch in (False, True):
+            qties_replenished = defaultdict(float)
+            for product, quantity in zip(products, quantities):
+                qties_replenished[product] = quantity[3]
+            results.append(
+                orderpoint._get_qties_to_replenish_for_products(
+                    products, qties_on_locations, qties_replenished, batch=batch
+                )
+            )
+        self.assertEqual(
+            results[0], [(products[2], 2), (products[3], 3), (products[4], 3)]
+        )
+        self.assertEqual(results[1], results[0])
+
+    def test_compute_quantities_dict(self):
+        """The quantities computed for several locations at once must match the
+        ones computed by the product for each location separately"""
+        orderpoint, location_src = self._create_orderpoint_complete(
+            "Stock2", trigger="manual"
+        )
+        product2 = self.product.copy()
+        sublocation = self.env["stock.location"].create(
+            {"name": "Bin", "location_id": self.location_dest.id}
+        )
+        self._create_quants(self.product, location_src, 10)
+        self._create_quants(product2, sublocation, 3)
+        self._create_outgoing_move(4)
+        self._create_outgoing_move(5, location=sublocation, product=product2)
+        self._create_move("Internal", 2, location_src, self.location_dest)
+        self._assert_compute_quantities_dict(
+            orderpoint.location_id | location_src, self.product | product2
+        )
+
+    def _assert_compute_quantities_dict(self, locations, products):
+        qties = self.env["stock.location.orderpoint"]._compute_quantities_dict(
+            locations, products
+        )
+        for location in locations:
+            expected = products.with_context(
+                location=location.id
+            )._compute_quantities_dict(None, None, None)
+            for product in products:
+                for field in (
+                    "qty_available",
+                    "incoming_qty",
+                    "outgoing_qty",
+                    "virtual_available",
+                ):
+                    self.assertEqual(
+                        qties[location][product][field],
+                        expected[product.id][field],
+                    )
+
+    def test_compute_quantities_dict_ledger_moved_location(self):
+        orderpoint, location_src = self._create_orderpoint_complete(
+            "Stock2", trigger="manual", use_forecast_ledger=True
+        )
+        locations = orderpoint.location_id | location_src
+        sub_location = self.env["stock.location"].create(
+            {"name": "Sub Stock", "location_id": self.location_dest.id}
+        )
+        self._create_quants(self.product, sub_location, 10)
+        self._assert_compute_quantities_dict(locations, self.product)
+        # the ledger of the old and new ancestors is updated
+        sub_location.location_id = location_src
+        self._assert_compute_quantities_dict(locations, self.product)
+        self.assertTrue(location_src.location_orderpoint_ledger_initialized)
+
+    def test_compute_quantities_dict_ledger(self):
+        orderpoint, location_src = self._create_orderpoint_complete(
+            "Stock2", trigger="manual", use_forecast_ledger=True
+        )
+        locations = orderpoint.location_id | location_src
+        # the ledger is initialized with the orderpoint, not when reading it
+        self.assertTrue(self.location_dest.location_orderpoint_ledger_initialized)
+        self._create_quants(self.product, location_src, 10)
+        self._create_outgoing_move(4)
+        self._assert_compute_quantities_dict(locations, self.product)
+
+        # quantities updated after the initialization are tracked by the ledger
+        move = self._create_move("Internal", 2, location_src, self.location_dest)
+        self._create_outgoing_move(3)
+        self._create_incoming_move(5, location_src)
+        self._assert_compute_quantities_dict(locations, self.product)
+        move._action_assign()
+        move.move_line_ids.write({"qty_done": 2})
+        move._action_done()
+        self._assert_compute_quantities_dict(locations, self.product)
+        ledger = self.env["stock.location.orderpoint.ledger"]
+        ledger._compact()
+        self.assertEqual(ledger.search_count([("product_id", "=", self.product.id)]), 2)
+        self._assert_compute_quantities_dict(locations, self.product)
+
+        orderpoint.use_forecast_ledger = False
+        self.assertFalse(self.location_dest.location_orderpoint_ledger_initialized)
+        self.assertFalse(ledger.search_count([("product_id", "=", self.product.id)]))